@@ -1,4 +1,4 @@
-import json
+import time
 
 from flask import current_app
 from flask_restful import marshal, fields
@@ -7,7 +7,13 @@ from redis.exceptions import RedisError
 from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm import load_only
 
+from cache import bloom
+from cache import codec
 from cache import constants
+from cache import local
+from cache import refresh
+from cache import singleflight
+from cache import xfetch
 from cache import user as cache_user
 from models.news import Article, Attitude
 from models.user import User
@@ -27,10 +33,40 @@ class ArticleInfoCache(object):
         self.key = 'art:{}:info'.format(article_id)
         self.article_id = article_id
 
+    @staticmethod
+    def _format(article_info, auth_info):
+        """
+        组织文章缓存数据
+        :param article_info: 文章对象
+        :param auth_info: 作者对象
+        :return: dict
+        """
+        return {
+            'id': article_info.id,
+            'title': article_info.title,
+            'auth': auth_info.id,
+            'pubdate': article_info.ctime.strftime('%Y-%m-%d %H:%M:%S'),
+            'channel_id': article_info.channel_id,
+            'comment_count': article_info.comment_count,
+            'allow_comment': article_info.allow_comment,
+            'like_count': auth_info.like_count,
+            'article_count': auth_info.article_count
+        }
+
+    @staticmethod
+    def _decode(article_cache):
+        """
+        解析缓存数据，-1标识表示文章不存在
+        """
+        return None if article_cache == b'-1' else xfetch.loads(article_cache)[0]
+
     def save(self):
         # 获取redis集群对象
         redis_cluster = current_app.redis_cluster
 
+        # 记录重建耗时，用于提前过期判断
+        start = time.monotonic()
+
         # redis中没有缓存的数据，查询mysql
         try:
             article_info = Article.query.options(load_only(
@@ -59,21 +95,14 @@ class ArticleInfoCache(object):
                 current_app.logger.error(e)
                 raise e
 
-            article_dict = {
-                'id': self.article_id,
-                'title': article_info.title,
-                'auth': auth_info.id,
-                'pubdate': article_info.ctime.strftime('%Y-%m-%d %H:%M:%S'),
-                'channel_id': article_info.channel_id,
-                'comment_count': article_info.comment_count,
-                'allow_comment': article_info.allow_comment,
-                'like_count': auth_info.like_count,
-                'article_count': auth_info.article_count
-            }
+            article_dict = self._format(article_info, auth_info)
 
-            article_info_str = json.dumps(article_dict)
+            ttl = constants.ArticleInfoCacheTTL.get_time()
+            article_info_str = xfetch.dumps(article_dict, time.monotonic() - start, ttl)
 
-            redis_cluster.setex(self.key, constants.ArticleInfoCacheTTL.get_time(), article_info_str)
+            redis_cluster.setex(self.key, xfetch.hard_time(constants.ArticleInfoCacheTTL, ttl), article_info_str)
+            # 本进程的一级缓存中可能是刷新前的数据
+            current_app.local_cache.delete(self.key)
 
             # 4、mysql有值，返回并回填
             return article_dict
@@ -84,12 +113,9 @@ class ArticleInfoCache(object):
             return None
 
     def get(self):
-        # 获取redis集群对象
-        redis_cluster = current_app.redis_cluster
-
-        # 从redis中获取文章缓存数据
+        # 从进程内缓存或redis中获取文章缓存数据
         try:
-            article_cache = redis_cluster.get(self.key)
+            article_cache = local.cluster_get(self.key, constants.ARTICLE_INFO_LOCAL_CACHE_TTL)
         except RedisError as e:
             current_app.logger.error(e)
             article_cache = None
@@ -99,11 +125,118 @@ class ArticleInfoCache(object):
             # 防止缓存穿透存的-1标识
             if article_cache == b'-1':
                 return None
-            else:
-                return json.loads(article_cache)
+
+            article_dict, delta, expiry = xfetch.loads(article_cache)
+            if constants.ArticleInfoCacheTTL.is_stale(expiry) \
+                    or constants.ArticleInfoCacheTTL.should_refresh(delta, expiry):
+                # 已软过期或临近过期时按概率提前刷新，使用当前数据并在后台刷新，请求中不查询数据库
+                refresh.refresh_in_background(self.key, self.save, self._decode, article_cache)
+            return article_dict
         else:
+            # 布隆过滤器判断文章一定不存在，不再查询数据库
+            if not bloom.ArticleBloomFilter.might_contain(self.article_id):
+                return None
+            # 合并并发的缓存重建
+            return singleflight.rebuild(self.key, self.save, self._decode)
+
+    @classmethod
+    def get_many(cls, article_ids):
+        """
+        批量获取文章缓存数据
+        redis集群管道会按槽位所在节点分组发送命令，每个节点一次往返
+        缓存缺失的文章使用一次IN查询文章、一次IN查询作者，再通过一次管道批量回填
+        :param article_ids: [article_id, ...]
+        :return: 与article_ids顺序一致的列表，不存在的文章为None
+        """
+        redis_cluster = current_app.redis_cluster
+
+        # 从进程内缓存或redis中批量获取文章缓存数据
+        try:
+            article_caches = local.cluster_get_many([cls(article_id).key for article_id in article_ids],
+                                                    constants.ARTICLE_INFO_LOCAL_CACHE_TTL)
+        except RedisError as e:
+            current_app.logger.error(e)
+            article_caches = [None] * len(article_ids)
+
+        articles = {}
+        need_db_query = []
+        for article_id, article_cache in zip(article_ids, article_caches):
+            if article_cache is None:
+                need_db_query.append(article_id)
+            elif article_cache == b'-1':
+                # 防止缓存穿透存的-1标识
+                articles[article_id] = None
+            else:
+                article_dict, delta, expiry = xfetch.loads(article_cache)
+                articles[article_id] = article_dict
+                if constants.ArticleInfoCacheTTL.is_stale(expiry) \
+                        or constants.ArticleInfoCacheTTL.should_refresh(delta, expiry):
+                    # 已软过期或临近过期时按概率提前刷新，使用当前数据并在后台刷新
+                    cache = cls(article_id)
+                    refresh.refresh_in_background(cache.key, cache.save, cls._decode, article_cache)
+
+        # 布隆过滤器判断一定不存在的文章，不再查询数据库
+        exists = bloom.ArticleBloomFilter.might_contain_many(need_db_query)
+        for article_id, article_exists in zip(need_db_query, exists):
+            if not article_exists:
+                articles[article_id] = None
+        need_db_query = [article_id for article_id, article_exists in zip(need_db_query, exists) if article_exists]
+
+        if not need_db_query:
+            return [articles[article_id] for article_id in article_ids]
+
+        start = time.monotonic()
+
+        # redis中没有缓存的数据，批量查询mysql
+        try:
+            article_infos = Article.query.options(load_only(
+                Article.id,
+                Article.title,
+                Article.user_id,
+                Article.ctime,
+                Article.channel_id,
+                Article.allow_comment,
+                Article.comment_count
+            )).filter(Article.id.in_(need_db_query), Article.status == Article.STATUS.APPROVED).all()
+
+            auth_ids = set(article_info.user_id for article_info in article_infos)
+            auth_infos = User.query.options(load_only(
+                User.id,
+                User.name,
+                User.like_count,
+                User.article_count
+            )).filter(User.id.in_(auth_ids)).all() if auth_ids else []
+        except DatabaseError as e:
+            current_app.logger.error(e)
+            raise e
 
-            return self.save()
+        auth_infos = {auth_info.id: auth_info for auth_info in auth_infos}
+        article_infos = {article_info.id: article_info for article_info in article_infos}
+
+        delta = time.monotonic() - start
+
+        # 批量回填，不存在的文章回填-1标识
+        pl = redis_cluster.pipeline()
+        for article_id in need_db_query:
+            article_info = article_infos.get(int(article_id))
+            auth_info = auth_infos.get(article_info.user_id) if article_info else None
+            if article_info and auth_info:
+                article_dict = cls._format(article_info, auth_info)
+                ttl = constants.ArticleInfoCacheTTL.get_time()
+                pl.setex(cls(article_id).key, xfetch.hard_time(constants.ArticleInfoCacheTTL, ttl),
+                         xfetch.dumps(article_dict, delta, ttl))
+                current_app.local_cache.delete(cls(article_id).key)
+                articles[article_id] = article_dict
+            else:
+                pl.setex(cls(article_id).key, constants.ArticleNotExistsCacheTTL.get_time(), '-1')
+                articles[article_id] = None
+
+        try:
+            pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+
+        return [articles[article_id] for article_id in article_ids]
 
     def exist(self):
         '''
@@ -124,9 +257,12 @@ class ArticleInfoCache(object):
         if article_cache is not None:
             return False if article_cache == b'-1' else True
 
+        elif not bloom.ArticleBloomFilter.might_contain(self.article_id):
+            return False
+
         else:
 
-            result = self.save()
+            result = singleflight.rebuild(self.key, self.save, self._decode)
 
             if result is None:
                 return False
@@ -145,9 +281,9 @@ class ArticleInfoCache(object):
             article_cache = None
 
         if article_cache is None:
-            article_formatted = self.save()
+            article_formatted = singleflight.rebuild(self.key, self.save, self._decode)
         else:
-            article_formatted = json.loads(article_cache)
+            article_formatted = self._decode(article_cache)
 
         return article_formatted['allow_comment']
 
@@ -156,6 +292,8 @@ class ArticleInfoCache(object):
         redis_cluster = current_app.redis_cluster  # type: StrictRedis
         redis_cluster.delete(self.key)
 
+        local.invalidate(self.key)
+
 
 class ChannelTopArticlesStorage(object):
     """
@@ -198,6 +336,100 @@ class ChannelTopArticlesStorage(object):
         return 0 if rank is None else 1
 
 
+class ChannelFallbackArticlesStorage(object):
+    """
+    频道降级文章列表
+    推荐系统超时或熔断时使用，由定时任务从近期审核通过的文章中按热度选出，按发布时间(毫秒)保存
+    """
+
+    def __init__(self, channel_id):
+        self.key = 'ch:{}:art:fallback'.format(channel_id)
+        self.channel_id = channel_id
+
+    def get(self, timestamp, count):
+        """
+        获取早于指定时间的文章
+        :param timestamp: 时间戳，毫秒
+        :param count: 数量
+        :return: [(article_id, timestamp), ...]
+        """
+        max_score = '({}'.format(timestamp)
+        try:
+            ret = current_app.redis_master.zrevrangebyscore(self.key, max_score, '-inf', start=0, num=count,
+                                                            withscores=True)
+        except RedisError as e:
+            current_app.logger.error(e)
+            ret = current_app.redis_slave.zrevrangebyscore(self.key, max_score, '-inf', start=0, num=count,
+                                                           withscores=True)
+
+        return [(int(article_id), int(score)) for article_id, score in ret]
+
+    def save(self, articles):
+        """
+        替换降级文章列表
+        :param articles: [(article_id, timestamp), ...]
+        """
+        redis_master = current_app.redis_master  # type: StrictRedis
+        tmp_key = '{}:tmp'.format(self.key)
+
+        cache = []
+        for article_id, timestamp in articles:
+            cache.append(timestamp)
+            cache.append(article_id)
+
+        pl = redis_master.pipeline()
+        if cache:
+            pl.delete(tmp_key)
+            pl.zadd(tmp_key, *cache)
+            pl.rename(tmp_key, self.key)
+        else:
+            pl.delete(self.key)
+        pl.execute()
+
+
+class FeedPageCache(object):
+    """
+    推荐文章列表分页结果缓存
+    以请求的时间戳为键，翻页请求携带的是上一页返回的pre_timestamp，重复请求和回翻时直接使用已组装好的结果
+    """
+
+    def __init__(self, user_id, channel_id, timestamp, with_top=0):
+        self.key = 'feed:{}:{}:{}:{}'.format(user_id or 'annoy', channel_id, timestamp, with_top)
+
+    def get(self):
+        """
+        获取
+        :return: 文章列表响应数据，不存在返回None
+        """
+        try:
+            ret = current_app.redis_cluster.get(self.key)
+        except RedisError as e:
+            current_app.logger.error(e)
+            return None
+
+        return codec.loads(ret) if ret is not None else None
+
+    def exists(self):
+        """
+        判断是否存在
+        """
+        try:
+            return bool(current_app.redis_cluster.exists(self.key))
+        except RedisError as e:
+            current_app.logger.error(e)
+            return False
+
+    def save(self, data):
+        """
+        保存
+        :param data: 文章列表响应数据
+        """
+        try:
+            current_app.redis_cluster.setex(self.key, constants.FeedPageCacheTTL.get_time(), codec.dumps(data))
+        except RedisError as e:
+            current_app.logger.error(e)
+
+
 class ArticleDetailCache(object):
     """
     文章详细内容缓存
@@ -230,7 +462,7 @@ class ArticleDetailCache(object):
 
         if article_bytes:
             # 使用缓存
-            article_dict = json.loads(article_bytes)
+            article_dict = codec.loads(article_bytes)
         else:
             # 查询数据库
             article = Article.query.options(load_only(
@@ -245,7 +477,7 @@ class ArticleDetailCache(object):
             article_dict = marshal(article, self.article_fields)
 
             # 缓存
-            article_cache = json.dumps(article_dict)
+            article_cache = codec.dumps(article_dict)
             try:
                 rc.setex(self.key, constants.ArticleDetailCacheTTL.get_time(), article_cache)
             except RedisError:
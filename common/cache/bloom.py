@@ -0,0 +1,274 @@
+import hashlib
+import threading
+import time
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from models import db
+from models.news import Article, Comment
+from models.user import User
+from . import constants
+
+
+# 合并种子数据与原有位图后原子替换，种子构建期间新增的id不会丢失
+REPLACE_BITMAP_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('bitop', 'or', KEYS[1], KEYS[1], KEYS[2])
+end
+return redis.call('rename', KEYS[1], KEYS[2])
+"""
+
+# 位图已建立或正在建立时才写入，种子构建期间写入的位会在替换时合并
+ADD_BITS_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 and redis.call('exists', KEYS[3]) == 0 then
+    return 0
+end
+for i = 1, #ARGV do
+    redis.call('setbit', KEYS[1], ARGV[i], 1)
+end
+return 1
+"""
+
+
+class BaseBloomFilter(object):
+    """
+    id存在性布隆过滤器，使用redis位图保存
+    返回不存在时数据一定不存在，用于拦截对不存在id的请求，避免缓存穿透查询数据库
+    位图尚未建立完成或redis异常时一律视为存在，是否建立完成以单独的标记键判断，不依赖位图键是否存在
+    大于上次更新时最大id的id尚未加入位图，也视为存在
+    """
+    key = ''
+    # 位图大小，位
+    SIZE = 2 ** 27
+    # 哈希函数个数
+    HASH_COUNT = 7
+    # 是否在进程内保存位图副本
+    MIRROR = False
+
+    _mirror = None
+    _mirror_expire_at = 0
+    _mirror_lock = threading.Lock()
+
+    @classmethod
+    def _offsets(cls, item_id):
+        """
+        计算id对应的位，双重哈希模拟多个哈希函数
+        """
+        digest = hashlib.md5(str(item_id).encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % cls.SIZE for i in range(cls.HASH_COUNT)]
+
+    @classmethod
+    def add(cls, item_id):
+        """
+        添加id，新增数据时调用
+        """
+        cls.add_many([item_id])
+
+    @classmethod
+    def add_many(cls, item_ids):
+        """
+        批量添加id，位图尚未建立时不写入，建立时会从数据库读取全部id
+        """
+        offsets = [offset for item_id in item_ids for offset in cls._offsets(item_id)]
+        if not offsets:
+            return
+        try:
+            current_app.redis_master.eval(ADD_BITS_SCRIPT, 3, cls.key, cls._ready_key(), cls._seeding_key(), *offsets)
+        except RedisError as e:
+            current_app.logger.error(e)
+
+    @classmethod
+    def _get_mirror(cls):
+        """
+        获取进程内的位图副本，过期后重新从redis读取
+        """
+        now = time.monotonic()
+        if now < cls._mirror_expire_at:
+            return cls._mirror
+
+        with cls._mirror_lock:
+            if now >= cls._mirror_expire_at:
+                try:
+                    pl = current_app.redis_master.pipeline(transaction=False)
+                    pl.exists(cls._ready_key())
+                    pl.get(cls.key)
+                    ready, bitmap = pl.execute()
+                    cls._mirror = bitmap if ready else None
+                except RedisError as e:
+                    current_app.logger.error(e)
+                    cls._mirror = None
+                cls._mirror_expire_at = now + constants.BLOOM_FILTER_MIRROR_TTL
+
+        return cls._mirror
+
+    @staticmethod
+    def _test_bits(bitmap, offsets):
+        """
+        在位图副本中判断各位是否均为1，redis位图的第0位是首字节的最高位
+        """
+        for offset in offsets:
+            index = offset >> 3
+            if index >= len(bitmap) or not (bitmap[index] >> (7 - (offset & 7))) & 1:
+                return False
+        return True
+
+    @classmethod
+    def might_contain_many(cls, item_ids):
+        """
+        批量判断id是否可能存在
+        进程内副本判断存在的直接返回，其余的通过一次管道向redis确认，副本建立后新增的id不会被误判
+        :param item_ids: [item_id, ...]
+        :return: 与item_ids顺序一致的[bool, ...]
+        """
+        results = [False] * len(item_ids)
+        offsets = [cls._offsets(item_id) for item_id in item_ids]
+
+        unknown = list(range(len(item_ids)))
+        if cls.MIRROR:
+            bitmap = cls._get_mirror()
+            if bitmap:
+                unknown = []
+                for index, item_offsets in enumerate(offsets):
+                    if cls._test_bits(bitmap, item_offsets):
+                        results[index] = True
+                    else:
+                        unknown.append(index)
+
+        if not unknown:
+            return results
+
+        try:
+            pl = current_app.redis_master.pipeline(transaction=False)
+            pl.exists(cls._ready_key())
+            pl.get(cls._max_id_key())
+            for index in unknown:
+                for offset in offsets[index]:
+                    pl.getbit(cls.key, offset)
+            bits = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            return [True] * len(item_ids)
+
+        # 位图尚未建立完成
+        if not bits[0]:
+            return [True] * len(item_ids)
+
+        # 文章和评论由其他系统写入，大于上次更新时最大id的数据尚未加入位图，视为可能存在
+        max_id = int(bits[1] or 0)
+        bits = bits[2:]
+        for position, index in enumerate(unknown):
+            item_bits = bits[position * cls.HASH_COUNT:(position + 1) * cls.HASH_COUNT]
+            results[index] = all(item_bits) or int(item_ids[index]) > max_id
+
+        return results
+
+    @classmethod
+    def might_contain(cls, item_id):
+        """
+        判断id是否可能存在
+        :return: False表示一定不存在
+        """
+        return cls.might_contain_many([item_id])[0]
+
+    @classmethod
+    def seed(cls):
+        """
+        从数据库全量建立位图
+        使用服务端游标分批读取id，在内存中构建位图后一次写入临时键，再与原位图合并并原子替换
+        """
+        bitmap = bytearray(cls.SIZE // 8)
+        max_id = 0
+        rows = 0
+        query = cls.db_query().execution_options(stream_results=True).yield_per(
+            constants.BLOOM_FILTER_SEED_CHUNK_SIZE)
+        for item_id, in query:
+            for offset in cls._offsets(item_id):
+                bitmap[offset >> 3] |= 1 << (7 - (offset & 7))
+            max_id = max(max_id, item_id)
+            rows += 1
+
+        redis_master = current_app.redis_master
+        tmp_key = '{}:tmp'.format(cls.key)
+        pl = redis_master.pipeline()
+        pl.set(tmp_key, bytes(bitmap))
+        pl.eval(REPLACE_BITMAP_SCRIPT, 2, tmp_key, cls.key)
+        pl.set(cls._max_id_key(), max_id)
+        pl.set(cls._ready_key(), 1)
+        pl.execute()
+        return rows
+
+    @classmethod
+    def update(cls):
+        """
+        增量添加上次更新后新增的id，位图未建立完成时全量建立
+        自增id的提交顺序与id顺序可能不一致，每次从上次最大id向前重叠一段重新添加，重复添加没有影响
+        :return: 添加的id数量
+        """
+        redis_master = current_app.redis_master
+
+        if not redis_master.exists(cls._ready_key()):
+            # 多个进程同时启动时只由一个进程建立
+            if redis_master.set(cls._seeding_key(), 1, nx=True, ex=constants.BLOOM_FILTER_SEED_LOCK_TTL):
+                return cls.seed()
+            return 0
+
+        max_id = int(redis_master.get(cls._max_id_key()) or 0)
+        since_id = max_id - constants.BLOOM_FILTER_UPDATE_ID_OVERLAP
+        query = cls.db_query().filter(cls.id_column > since_id).order_by(cls.id_column) \
+            .execution_options(stream_results=True).yield_per(constants.BLOOM_FILTER_SEED_CHUNK_SIZE)
+
+        rows = 0
+        item_ids = []
+        for item_id, in query:
+            rows += 1
+            item_ids.append(item_id)
+            if len(item_ids) >= constants.BLOOM_FILTER_SEED_CHUNK_SIZE:
+                cls.add_many(item_ids)
+                redis_master.set(cls._max_id_key(), max(item_ids[-1], max_id))
+                item_ids = []
+
+        if item_ids:
+            cls.add_many(item_ids)
+            redis_master.set(cls._max_id_key(), max(item_ids[-1], max_id))
+
+        return rows
+
+    @classmethod
+    def _max_id_key(cls):
+        return '{}:max_id'.format(cls.key)
+
+    @classmethod
+    def _ready_key(cls):
+        return '{}:ready'.format(cls.key)
+
+    @classmethod
+    def _seeding_key(cls):
+        return '{}:seeding'.format(cls.key)
+
+    @classmethod
+    def db_query(cls):
+        return db.session.query(cls.id_column)
+
+
+class ArticleBloomFilter(BaseBloomFilter):
+    """文章id布隆过滤器"""
+    key = 'bf:art'
+    SIZE = 2 ** 26
+    MIRROR = True
+    id_column = Article.id
+
+
+class UserBloomFilter(BaseBloomFilter):
+    """用户id布隆过滤器"""
+    key = 'bf:user'
+    id_column = User.id
+
+
+class CommentBloomFilter(BaseBloomFilter):
+    """评论id布隆过滤器"""
+    key = 'bf:comm'
+    SIZE = 2 ** 28
+    id_column = Comment.id
@@ -1,10 +1,11 @@
-import json
 from sqlalchemy.orm import load_only, contains_eager
 from flask import current_app
 from redis.exceptions import RedisError
 
 from models.news import Channel, UserChannel
+from . import codec
 from . import constants
+from . import local
 
 
 class AllChannelsCache(object):
@@ -22,9 +23,9 @@ class AllChannelsCache(object):
         rc = current_app.redis_cluster
 
         # 缓存取数据
-        ret = rc.get(cls.key)
+        ret = local.cluster_get(cls.key, constants.CHANNELS_LOCAL_CACHE_TTL)
         if ret:
-            results = json.loads(ret)
+            results = codec.loads(ret)
             return results
 
         # 数据库查询
@@ -44,7 +45,7 @@ class AllChannelsCache(object):
 
         # 设置缓存
         try:
-            rc.setex(cls.key, constants.ALL_CHANNELS_CACHE_TTL, json.dumps(results))
+            rc.setex(cls.key, constants.ALL_CHANNELS_CACHE_TTL, codec.dumps(results))
         except RedisError as e:
             current_app.logger.error(e)
 
@@ -65,6 +66,20 @@ class AllChannelsCache(object):
                 return True
         return False
 
+    @classmethod
+    def clear(cls):
+        """
+        清除缓存
+        """
+        rc = current_app.redis_cluster
+
+        try:
+            rc.delete(cls.key)
+        except RedisError as e:
+            current_app.logger.error(e)
+
+        local.invalidate(cls.key)
+
 
 class UserDefaultChannelsCache(object):
     """
@@ -82,13 +97,13 @@ class UserDefaultChannelsCache(object):
 
         # 缓存取数据
         try:
-            ret = rc.get(cls.key)
+            ret = local.cluster_get(cls.key, constants.CHANNELS_LOCAL_CACHE_TTL)
         except RedisError as e:
             current_app.logger.error(e)
             ret = None
 
         if ret:
-            results = json.loads(ret)
+            results = codec.loads(ret)
             return results
 
         # 数据库查询
@@ -108,7 +123,7 @@ class UserDefaultChannelsCache(object):
 
         # 设置缓存
         try:
-            rc.setex(cls.key, constants.DEFAULT_USER_CHANNELS_CACHE_TTL, json.dumps(results))
+            rc.setex(cls.key, constants.DEFAULT_USER_CHANNELS_CACHE_TTL, codec.dumps(results))
         except RedisError as e:
             current_app.logger.error(e)
 
@@ -126,6 +141,8 @@ class UserDefaultChannelsCache(object):
         except RedisError as e:
             current_app.logger.error(e)
 
+        local.invalidate(cls.key)
+
 
 class UserChannelsCache(object):
     """
@@ -148,7 +165,7 @@ class UserChannelsCache(object):
             ret = None
 
         if ret:
-            return json.loads(ret)
+            return codec.loads(ret)
 
         # error
         # user_channels = UserChannel.query.options(load_only(UserChannel.channel_id),
@@ -171,7 +188,7 @@ class UserChannelsCache(object):
             })
 
         try:
-            rc.setex(self.key, constants.UserChannelsCacheTTL.get_val(), json.dumps(results))
+            rc.setex(self.key, constants.UserChannelsCacheTTL.get_time(), codec.dumps(results))
         except RedisError as e:
             current_app.logger.error(e)
 
@@ -0,0 +1,66 @@
+import json
+
+import msgpack
+from flask import current_app
+
+
+class JsonCodec(object):
+    """
+    JSON格式，即原有的缓存格式，没有格式版本字节
+    """
+    version = b''
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data).encode()
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec(object):
+    """
+    msgpack二进制格式
+    """
+    version = b'\x01'
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+# 格式版本字节 -> 编码器，JSON数据不会以这些字节开头
+_VERSIONED_CODECS = {codec.version: codec for codec in CODECS.values() if codec.version}
+
+
+def dumps(data, name=None):
+    """
+    序列化缓存数据，在数据前加上格式版本字节
+    :param data: 缓存数据
+    :param name: 编码器名称，默认使用配置CACHE_CODEC
+    :return: bytes
+    """
+    if name is None:
+        name = current_app.config.get('CACHE_CODEC', 'json')
+    codec = CODECS[name]
+    return codec.version + codec.encode(data)
+
+
+def loads(raw):
+    """
+    根据格式版本字节反序列化缓存数据，没有版本字节的按JSON处理，滚动发布期间新旧格式均可读取
+    :param raw: redis中的原始数据
+    :return: 缓存数据
+    """
+    codec = _VERSIONED_CODECS.get(raw[:1], JsonCodec)
+    return codec.decode(raw[len(codec.version):])
@@ -2,14 +2,15 @@ from sqlalchemy.orm import load_only, joinedload
 from sqlalchemy import func
 from flask_restful import marshal, fields
 import time
-from flask import current_app
+from flask import current_app, g
 from redis.exceptions import RedisError
-import json
 
 from models import db
 from models.user import User
 from models.news import Comment
 from cache import user as cache_user
+from . import bloom
+from . import codec
 from . import constants
 from cache import persstorage as cache_statistic
 
@@ -43,7 +44,7 @@ class CommentCache(object):
         else:
             if comment is None:
                 return None
-            comment = json.loads(comment)
+            comment = codec.loads(comment)
             comment = CommentCache.fill_fields(comment)
             return comment
 
@@ -61,30 +62,67 @@ class CommentCache(object):
         comment['reply_count'] = cache_statistic.CommentReplyCountStorage.get(comment['com_id'])
         return comment
 
+    @classmethod
+    def fill_fields_many(cls, comments):
+        """
+        批量补充字段
+        作者资料批量获取，点赞数与回复数通过一次管道获取，登录用户的点赞状态预先批量获取
+        :param comments: [comment, ...]
+        :return: comments
+        """
+        if not comments:
+            return comments
+
+        users = cache_user.UserProfileCache.get_many(list({comment['aut_id'] for comment in comments}))
+
+        counts = cache_statistic.BaseCountStorage.get_multi_storage(
+            [comment['com_id'] for comment in comments],
+            [cache_statistic.CommentLikingCountStorage, cache_statistic.CommentReplyCountStorage]
+        )
+
+        # 登录用户对整页评论的点赞状态一次获取，之后逐条判断时不再访问redis
+        user_id = getattr(g, 'user_id', None)
+        if user_id:
+            cache_user.UserCommentLikingCache(user_id).prefetch([comment['com_id'] for comment in comments])
+
+        for comment, (like_count, reply_count) in zip(comments, counts):
+            _user = users.get(comment['aut_id']) or {}
+            comment['aut_name'] = _user.get('name')
+            comment['aut_photo'] = _user.get('profile_photo')
+            comment['like_count'] = like_count
+            comment['reply_count'] = reply_count
+
+        return comments
+
     @classmethod
     def get_list(cls, comment_ids):
         """
         批量获取
+        评论缓存通过一次集群管道读取，缺失的评论使用一次IN查询，最后批量补充字段
         """
         rc = current_app.redis_cluster
 
         comments = {}
         need_db_query = []
-        sorted_comments = []
 
         # 从缓存查询，没有就记录
-        for comment_id in comment_ids:
-            comment = CommentCache(comment_id).get()
+        try:
+            pl = rc.pipeline()
+            for comment_id in comment_ids:
+                pl.get(CommentCache(comment_id).key)
+            caches = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            caches = [None] * len(comment_ids)
+
+        for comment_id, comment in zip(comment_ids, caches):
             if comment is None:
                 need_db_query.append(comment_id)
-            else:
-                comments[comment_id] = comment
-                sorted_comments.append(comment)
+            elif comment != b'-1':
+                comments[comment_id] = codec.loads(comment)
 
         # 数据库查询缓存缺失的
-        if not need_db_query:
-            return sorted_comments
-        else:
+        if need_db_query:
             ret = Comment.query.filter(Comment.id.in_(need_db_query),
                                        Comment.status == Comment.STATUS.APPROVED).all()
             pl = rc.pipeline()
@@ -93,10 +131,8 @@ class CommentCache(object):
                 formatted_comment = marshal(comment, cls.comment_fields)
 
                 # 保存缓存
-                pl.setex(CommentCache(comment.id).key, constants.CommentCacheTTL.get_val(), json.dumps(formatted_comment))
-
-                # 处理字段
-                formatted_comment = cls.fill_fields(formatted_comment)
+                pl.setex(CommentCache(comment.id).key, constants.CommentCacheTTL.get_time(),
+                         codec.dumps(formatted_comment))
                 comments[comment.id] = formatted_comment
 
             try:
@@ -104,11 +140,11 @@ class CommentCache(object):
             except RedisError as e:
                 current_app.logger.error(e)
 
-            # 排序
-            sorted_comments = []
-            for comment_id in comment_ids:
-                sorted_comments.append(comments[comment_id])
-            return sorted_comments
+        # 排序
+        sorted_comments = [comments[comment_id] for comment_id in comment_ids if comment_id in comments]
+
+        # 处理字段
+        return cls.fill_fields_many(sorted_comments)
 
     def exists(self):
         """
@@ -124,13 +160,16 @@ class CommentCache(object):
 
         if ret:
             return False if ret == b'-1' else True
+        elif not bloom.CommentBloomFilter.might_contain(self.comment_id):
+            # 布隆过滤器判断评论一定不存在，不再查询数据库
+            return False
         else:
             # 数据库查询
             comment = self.save()
             if comment is None:
                 # 不存在, 设置缓存，防止击穿
                 try:
-                    rc.setex(self.key, constants.CommentNotExistsCacheTTL.get_val(), '-1')
+                    rc.setex(self.key, constants.CommentNotExistsCacheTTL.get_time(), '-1')
                 except RedisError as e:
                     current_app.logger.error(e)
 
@@ -153,8 +192,8 @@ class CommentCache(object):
             # 设置缓存
             formatted_comment = marshal(comment, self.comment_fields)
             try:
-                current_app.redis_cluster.setex(self.key, constants.CommentCacheTTL.get_val(),
-                                                json.dumps(formatted_comment))
+                current_app.redis_cluster.setex(self.key, constants.CommentCacheTTL.get_time(),
+                                                codec.dumps(formatted_comment))
             except RedisError as e:
                 current_app.logger.error(e)
 
@@ -319,7 +358,7 @@ class ArticleCommentsCache(CommentsAndRepliesCacheBase):
                             Comment.status == Comment.STATUS.APPROVED)
 
     def _get_cache_ttl(self):
-        return constants.ArticleCommentsCacheTTL.get_val()
+        return constants.ArticleCommentsCacheTTL.get_time()
 
 
 class CommentRepliesCache(CommentsAndRepliesCacheBase):
@@ -337,4 +376,4 @@ class CommentRepliesCache(CommentsAndRepliesCacheBase):
                             Comment.status == Comment.STATUS.APPROVED)
 
     def _get_cache_ttl(self):
-        return constants.CommentRepliesCacheTTL.get_val()
+        return constants.CommentRepliesCacheTTL.get_time()
@@ -1,4 +1,6 @@
+import math
 import random
+import time
 
 
 # 缓存评论最大SCORE
@@ -34,6 +36,108 @@ ALLOW_UPDATE_ARTICLE_COMMENTS_CACHE_TTL_LIMIT = 5
 # 系统公告缓存时间，秒
 ANNOUNCEMENTS_CACHE_TTL = 48 * 60 * 60
 
+# 进程内一级缓存最大条目数
+LOCAL_CACHE_MAX_SIZE = 10000
+
+# 进程内一级缓存失效通知的pub/sub频道
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'cache:local:invalidation'
+
+# 频道缓存在进程内的有效期，秒
+CHANNELS_LOCAL_CACHE_TTL = 5 * 60
+
+# 文章信息缓存在进程内的有效期，秒
+ARTICLE_INFO_LOCAL_CACHE_TTL = 60
+
+# 缓存重建锁的有效期，毫秒
+REBUILD_LOCK_TTL = 3000
+
+# 未获取到缓存重建锁时等待缓存回填的最长时间，秒
+REBUILD_LOCK_WAIT = 1
+
+# 等待缓存回填的轮询间隔，秒
+REBUILD_LOCK_POLL_INTERVAL = 0.05
+
+# 后台刷新缓存的线程数
+CACHE_REFRESH_POOL_MAX_WORKERS = 4
+
+# 后台刷新缓存最多排队的任务数，超出后放弃本次刷新
+CACHE_REFRESH_POOL_MAX_PENDING = 100
+
+# 统计数据重建时每批写入redis的数量
+COUNT_STORAGE_RESET_CHUNK_SIZE = 1000
+
+# 统计数据修正时临时键的有效期，每批写入时续期，秒
+COUNT_STORAGE_RESET_TMP_TTL = 30 * 60
+
+# 统计数据增量缓冲的写入间隔，秒
+COUNT_INCR_BUFFER_FLUSH_INTERVAL = 0.2
+
+# 统计数据增量缓冲累计多少次后立即写入
+COUNT_INCR_BUFFER_MAX_EVENTS = 1000
+
+# 用户文章、收藏等列表缓存保存的最大条数，更早的数据查询数据库
+USER_LIST_CACHE_LIMIT = 1000
+
+# 用户粉丝列表缓存保存的最大条数
+USER_FOLLOWERS_CACHE_LIMIT = 10000
+
+# 用户列表缓存重建时每批读取和写入的数量
+USER_LIST_CACHE_REBUILD_CHUNK_SIZE = 1000
+
+# 推荐文章列表后台预取的线程数
+FEED_PREFETCH_POOL_MAX_WORKERS = 4
+
+# 推荐文章列表后台预取最多排队的任务数，超出后放弃本次预取
+FEED_PREFETCH_POOL_MAX_PENDING = 200
+
+# 降级文章列表从最近多少天审核通过的文章中选取
+FALLBACK_FEED_DAYS = 7
+
+# 降级文章列表每次最多参与排序的文章数量
+FALLBACK_FEED_CANDIDATES = 10000
+
+# 每个频道降级文章列表保存的文章数量
+FALLBACK_FEED_SIZE = 200
+
+# 统计数据增量修正的水位线，hash: {统计数据键: 上次修正开始时间戳}
+COUNT_STORAGE_WATERMARK_KEY = 'count:watermark'
+
+# 统计数据增量修正时水位线向前重叠的时间，覆盖修正开始时尚未提交的事务，秒
+COUNT_STORAGE_WATERMARK_OVERLAP = 60
+
+# 不支持增量修正的统计数据全量修正的最小间隔，秒
+COUNT_STORAGE_FULL_FIX_INTERVAL = 60 * 60
+
+# 统计数据迁移到分片时成员迁移标记的有效期，秒
+COUNT_STORAGE_MIGRATE_MARKER_TTL = 24 * 60 * 60
+
+# 定时任务领导锁的租期，持有期间每1/3租期续期一次，毫秒
+SCHEDULE_LOCK_TTL = 30 * 1000
+
+# 定时任务执行间隔，任务完成后领导锁保留到本次开始后的一个间隔，其他进程在此期间触发时跳过，秒
+SCHEDULE_FIX_STATISTICS_INTERVAL = 10 * 60
+SCHEDULE_FULL_FIX_STATISTICS_INTERVAL = 24 * 60 * 60
+SCHEDULE_BLOOM_FILTER_INTERVAL = 60
+SCHEDULE_FALLBACK_FEED_INTERVAL = 5 * 60
+
+# 领导锁保留时长比执行间隔提前结束的时间，需大于调度器触发与任务派发的延迟，保证同一进程的下次触发能获取到锁，秒
+SCHEDULE_LOCK_HOLD_MARGIN = 5
+
+# 定时任务执行指标，hash: {duration: 耗时秒, rows: 处理数据条数, finished_at: 完成时间戳}
+SCHEDULE_METRICS_KEY = 'schedule:metrics:{}'
+
+# 布隆过滤器建立时每批读取的id数量
+BLOOM_FILTER_SEED_CHUNK_SIZE = 10000
+
+# 布隆过滤器全量建立锁的有效期，秒
+BLOOM_FILTER_SEED_LOCK_TTL = 10 * 60
+
+# 布隆过滤器增量更新时从上次最大id向前重叠的id数量，覆盖id较小但提交较晚的事务
+BLOOM_FILTER_UPDATE_ID_OVERLAP = 1000
+
+# 布隆过滤器进程内副本的有效期，秒
+BLOOM_FILTER_MIRROR_TTL = 60
+
 
 class BaseCacheTTL(object):
     """
@@ -44,12 +148,47 @@ class BaseCacheTTL(object):
     TTL = 30 * 60
     # 随机值的上线
     MAX_DELTA = 10 * 60
+    # 提前过期(XFetch)系数，None表示不开启，值越大越倾向于提前刷新
+    BETA = None
+    # 软过期后继续使用旧数据并后台刷新的时长，None表示不开启
+    STALE_TTL = None
 
     @classmethod
     def get_time(cls):
         # 随机过期时长
         return cls.TTL + random.randrange(0, cls.MAX_DELTA)
 
+    @classmethod
+    def should_refresh(cls, delta, expiry):
+        """
+        概率提前过期，越接近过期时间、重建耗时越长，提前刷新的概率越大
+        :param delta: 上次重建缓存的耗时，秒
+        :param expiry: 缓存过期的时间戳
+        :return: bool
+        """
+        if cls.BETA is None or expiry is None:
+            return False
+        return time.time() - delta * cls.BETA * math.log(1 - random.random()) >= expiry
+
+    @classmethod
+    def get_hard_time(cls, ttl):
+        """
+        redis中键的实际有效时长，软过期后仍保留STALE_TTL供读取旧数据
+        :param ttl: 软过期时长，秒
+        """
+        return ttl + (cls.STALE_TTL or 0)
+
+    @classmethod
+    def is_stale(cls, expiry):
+        """
+        判断缓存是否已软过期
+        :param expiry: 缓存软过期的时间戳
+        :return: bool
+        """
+        if cls.STALE_TTL is None or expiry is None:
+            return False
+        return time.time() >= expiry
+
 
 class UserProfileCacheTTL(BaseCacheTTL):
     """
@@ -57,6 +196,8 @@ class UserProfileCacheTTL(BaseCacheTTL):
     """
     TTL = 60 * 60
     MAX_DELTA = 16 * 60
+    BETA = 1.0
+    STALE_TTL = 10 * 60
 
 
 class UserStatusCacheTTL(BaseCacheTTL):
@@ -159,6 +300,8 @@ class ArticleInfoCacheTTL(BaseCacheTTL):
     文章信息缓存时间，秒
     """
     TTL = 30 * 60
+    BETA = 1.0
+    STALE_TTL = 10 * 60
 
 
 class ArticleNotExistsCacheTTL(BaseCacheTTL):
@@ -246,3 +389,12 @@ class AnnouncementNotExistsCacheTTL(BaseCacheTTL):
     """
     TTL = 5 * 60
     MAX_DELTA = 60
+
+
+class FeedPageCacheTTL(BaseCacheTTL):
+    """
+    推荐文章列表分页结果缓存时间，秒
+    只用于重复请求和回翻，有效期不宜过长
+    """
+    TTL = 5 * 60
+    MAX_DELTA = 60
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import constants
+
+
+class LocalCache(object):
+    """
+    进程内一级缓存，LRU淘汰 + TTL过期
+    保存的是redis中的原始数据(bytes)，每次读取仍由缓存类自行反序列化，避免调用方修改共享对象
+    """
+
+    def __init__(self, max_size=constants.LOCAL_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        获取
+        :param key: 缓存键
+        :return: 缓存值，不存在或已过期返回None
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            value, expire_at = item
+            if expire_at <= time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """
+        设置
+        :param key: 缓存键
+        :param value: 缓存值
+        :param ttl: 有效期，秒
+        """
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        删除
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        清空
+        """
+        with self._lock:
+            self._data.clear()
+
+
+class LocalCacheInvalidationListener(threading.Thread):
+    """
+    订阅缓存失效频道，删除本进程中对应的一级缓存
+    """
+
+    def __init__(self, app):
+        super().__init__(name='local-cache-invalidation', daemon=True)
+        self.app = app
+
+    def run(self):
+        local_cache = self.app.local_cache
+
+        while True:
+            try:
+                pubsub = self.app.redis_master.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(constants.LOCAL_CACHE_INVALIDATION_CHANNEL)
+
+                # (重新)订阅前可能错过了失效消息，清空本进程缓存
+                local_cache.clear()
+
+                for message in pubsub.listen():
+                    local_cache.delete(message['data'].decode())
+            except RedisError as e:
+                self.app.logger.error(e)
+                time.sleep(1)
+
+
+def cluster_get(key, local_ttl):
+    """
+    先查进程内缓存，未命中再查redis集群并回填进程内缓存
+    :param key: 缓存键
+    :param local_ttl: 进程内缓存有效期，秒
+    :return: redis中的原始数据
+    """
+    local_cache = current_app.local_cache
+
+    value = local_cache.get(key)
+    if value is None:
+        value = current_app.redis_cluster.get(key)
+        if value is not None:
+            local_cache.set(key, value, local_ttl)
+
+    return value
+
+
+def cluster_get_many(keys, local_ttl):
+    """
+    批量获取，进程内缓存未命中的键通过一次redis集群管道获取
+    :param keys: [key, ...]
+    :param local_ttl: 进程内缓存有效期，秒
+    :return: 与keys顺序一致的原始数据列表
+    """
+    local_cache = current_app.local_cache
+
+    values = [local_cache.get(key) for key in keys]
+    missing = [index for index, value in enumerate(values) if value is None]
+
+    if missing:
+        pl = current_app.redis_cluster.pipeline()
+        for index in missing:
+            pl.get(keys[index])
+
+        for index, value in zip(missing, pl.execute()):
+            if value is not None:
+                local_cache.set(keys[index], value, local_ttl)
+            values[index] = value
+
+    return values
+
+
+def invalidate(key):
+    """
+    删除本进程中的缓存，并通知其他进程删除
+    :param key: 缓存键
+    """
+    current_app.local_cache.delete(key)
+
+    try:
+        current_app.redis_master.publish(constants.LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+    except RedisError as e:
+        current_app.logger.error(e)
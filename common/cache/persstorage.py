@@ -1,66 +1,424 @@
+import atexit
+import threading
+import time
+import uuid
+import zlib
+from collections import defaultdict
+
 from flask import current_app
 from redis import StrictRedis
-from redis.exceptions import RedisError
+from redis.exceptions import RedisError, ResponseError
 from sqlalchemy import func
 from sqlalchemy.orm import load_only
 
 from models import db
+from . import constants
 from models.news import Article, Collection, Attitude, CommentLiking, Comment, ArticleStatistic
 from models.user import Relation
 
 
+# 迁移旧数据时每个成员只累加一次，迁移标记与分片键位于同一槽位，中断或多个进程同时迁移时不会重复累加
+MIGRATE_MEMBERS_SCRIPT = """
+local added = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('hsetnx', KEYS[2], ARGV[i], 1) == 1 then
+        redis.call('zincrby', KEYS[1], ARGV[i + 1], ARGV[i])
+        added = added + 1
+    end
+end
+redis.call('expire', KEYS[2], ARGV[1])
+return added
+"""
+
+
+# 临时键替换正式键并去掉临时键的过期时间，两个键位于同一槽位
+RENAME_PERSIST_SCRIPT = """
+redis.call('rename', KEYS[1], KEYS[2])
+return redis.call('persist', KEYS[2])
+"""
+
+
+# redis服务器是否支持ZMSCORE命令(6.2+)，首次批量查询时探测
+_zmscore_supported = None
+
+
+def _supports_zmscore(redis_client):
+    global _zmscore_supported
+    if _zmscore_supported is None:
+        version = redis_client.info('server')['redis_version']
+        _zmscore_supported = tuple(int(v) for v in version.split('.')[:2]) >= (6, 2)
+    return _zmscore_supported
+
+
+def _zscore_many(redis_client, key_members, use_zmscore):
+    """
+    一次管道获取多个有序集合中多个成员的分数
+    :param key_members: {key: [member, ...]}
+    :param use_zmscore: 是否使用ZMSCORE命令
+    :return: {(key, member): score}
+    """
+    pl = redis_client.pipeline(transaction=False)
+    if use_zmscore:
+        for key, members in key_members.items():
+            pl.execute_command('ZMSCORE', key, *members)
+        results = pl.execute()
+        return {(key, member): score
+                for (key, members), scores in zip(key_members.items(), results)
+                for member, score in zip(members, scores)}
+
+    for key, members in key_members.items():
+        for member in members:
+            pl.zscore(key, member)
+    scores = iter(pl.execute())
+    return {(key, member): next(scores) for key, members in key_members.items() for member in members}
+
+
+class CountIncrBuffer(object):
+    """
+    统计数据增量缓冲
+    在进程内合并增量，每隔一段时间或累计一定次数后通过一次管道写入redis，进程退出时写入剩余增量
+    """
+
+    def __init__(self, app, flush_interval=constants.COUNT_INCR_BUFFER_FLUSH_INTERVAL,
+                 max_events=constants.COUNT_INCR_BUFFER_MAX_EVENTS):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._deltas = defaultdict(int)
+        self._events = 0
+        self._thread = threading.Thread(target=self._run, name='count-incr-buffer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def add(self, key, member, amount, cluster=False):
+        """
+        记录增量
+        :param cluster: 统计数据是否保存在redis集群中
+        """
+        with self._lock:
+            self._deltas[(cluster, key, member)] += amount
+            self._events += 1
+            full = self._events >= self.max_events
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        将合并后的增量写入redis，失败时放回缓冲等待下次写入
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, defaultdict(int)
+                self._events = 0
+
+            deltas = {item: delta for item, delta in deltas.items() if delta}
+            if not deltas:
+                return
+
+            for cluster in (False, True):
+                items = {item: delta for item, delta in deltas.items() if item[0] == cluster}
+                if not items:
+                    continue
+
+                redis_client = self.app.redis_cluster if cluster else self.app.redis_master
+                pl = redis_client.pipeline(transaction=False)
+                for (_, key, member), delta in items.items():
+                    pl.zincrby(key, member, delta)
+
+                try:
+                    pl.execute()
+                except RedisError as e:
+                    self.app.logger.error(e)
+                    with self._lock:
+                        for item, delta in items.items():
+                            self._deltas[item] += delta
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.app.logger.error(e)
+
+
 class BaseCountStorage(object):
     key = ''
+    # 是否缓冲增量后批量写入，开启后读取到的数据最多延迟一个写入周期
+    BUFFERED = False
+    # 分片数量，按id哈希拆分为多个有序集合，避免单个键成为热点
+    SHARDS = 1
+    # 是否保存在redis集群中，分片可分布到不同节点
+    CLUSTER = False
+    # 增量修正使用的统计对象id列与数据更新时间列，未设置时只能全量修正
+    id_column = None
+    update_column = None
+
+    @classmethod
+    def _sharded(cls):
+        return cls.SHARDS > 1 or cls.CLUSTER
+
+    @classmethod
+    def _shard_key(cls, shard):
+        # 使用hash tag，分片键与其临时键位于同一槽位，便于RENAME
+        return '{{{}:{}}}'.format(cls.key, shard)
+
+    @classmethod
+    def _key_for(cls, member):
+        """
+        获取id所在的有序集合键
+        """
+        if not cls._sharded():
+            return cls.key
+        return cls._shard_key(zlib.crc32(str(member).encode()) % cls.SHARDS)
+
+    @classmethod
+    def _all_keys(cls):
+        if not cls._sharded():
+            return [cls.key]
+        return [cls._shard_key(shard) for shard in range(cls.SHARDS)]
+
+    @classmethod
+    def _write_client(cls):
+        return current_app.redis_cluster if cls.CLUSTER else current_app.redis_master
 
     @classmethod
     def get(cls, user_id):
         # 获取主从连接对象
 
         article_count = None
-        redis_master = current_app.redis_master  # type: StrictRedis
-        redis_slave = current_app.redis_slave  # type: StrictRedis
+        key = cls._key_for(user_id)
 
-        try:
-            article_count = redis_master.zscore(cls.key, user_id)
-        except RedisError as e:
-            current_app.logger.error(e)
-            article_count = redis_slave.zscore(cls.key, user_id)
+        if cls.CLUSTER:
+            # redis集群自行处理主从切换
+            article_count = current_app.redis_cluster.zscore(key, user_id)
+        else:
+            redis_master = current_app.redis_master  # type: StrictRedis
+            redis_slave = current_app.redis_slave  # type: StrictRedis
+
+            try:
+                article_count = redis_master.zscore(key, user_id)
+            except RedisError as e:
+                current_app.logger.error(e)
+                article_count = redis_slave.zscore(key, user_id)
 
         if article_count:
             return int(article_count)
         else:
             return 0
 
+    @classmethod
+    def get_many(cls, ids):
+        """
+        批量获取
+        :param ids: [id, ...]
+        :return: [count, ...]，与ids顺序一致
+        """
+        return [counts[0] for counts in cls.get_multi_storage(ids, [cls])]
+
+    @staticmethod
+    def get_multi_storage(ids, storages):
+        """
+        一次往返批量获取多个统计数据，保存在redis集群中的统计数据另需一次集群管道
+        :param ids: [id, ...]
+        :param storages: [StorageA, StorageB, ...]
+        :return: [(count_a, count_b, ...), ...]，与ids顺序一致
+        """
+        if not ids:
+            return []
+
+        scores = {}
+        for cluster in (False, True):
+            group = [storage for storage in storages if storage.CLUSTER == cluster]
+            if not group:
+                continue
+
+            key_members = defaultdict(list)
+            for storage in group:
+                for member in ids:
+                    key_members[storage._key_for(member)].append(member)
+
+            if cluster:
+                scores.update(_zscore_many(current_app.redis_cluster, key_members, False))
+                continue
+
+            redis_master = current_app.redis_master  # type: StrictRedis
+            redis_slave = current_app.redis_slave  # type: StrictRedis
+            try:
+                scores.update(_zscore_many(redis_master, key_members, _supports_zmscore(redis_master)))
+            except RedisError as e:
+                current_app.logger.error(e)
+                scores.update(_zscore_many(redis_slave, key_members, _supports_zmscore(redis_slave)))
+
+        results = []
+        for member in ids:
+            counts = []
+            for storage in storages:
+                score = scores[(storage._key_for(member), member)]
+                counts.append(int(float(score)) if score else 0)
+            results.append(tuple(counts))
+        return results
+
     @classmethod
     def incr(cls, user_id, incr_num=1):
-        redis_master = current_app.redis_master  # type: StrictRedis
+        key = cls._key_for(user_id)
+
+        if cls.BUFFERED:
+            current_app.count_incr_buffer.add(key, user_id, incr_num, cls.CLUSTER)
+            return
+
+        redis_client = cls._write_client()  # type: StrictRedis
         try:
-            redis_master.zincrby(cls.key, user_id, incr_num)
+            redis_client.zincrby(key, user_id, incr_num)
         except RedisError as e:
             current_app.logger.error(e)
             raise e
 
-    # 将最新的修正数据保存到redis中
+    # 将最新的修正数据保存到redis中，返回写入的数据条数
+    # 分批写入临时键，完成后RENAME原子替换，重建期间读取到的始终是完整的旧数据
     @classmethod
     def reset(cls, result):
+        redis_client = cls._write_client()  # type: StrictRedis
+        # 多个进程可能同时修正，每次使用独立的临时键，分片键中的hash tag保证临时键与分片键位于同一槽位
+        suffix = uuid.uuid4().hex
+        tmp_keys = {key: '{}:tmp:{}'.format(key, suffix) for key in cls._all_keys()}
+
+        written = set()
+        rows = 0
+        try:
+            caches = defaultdict(list)
+            for user_id, count in result:
+                rows += 1
+                key = cls._key_for(user_id)
+                cache = caches[key]
+                cache.append(count)
+                cache.append(user_id)
+                if len(cache) >= 2 * constants.COUNT_STORAGE_RESET_CHUNK_SIZE:
+                    written.add(key)
+                    cls._write_tmp(redis_client, tmp_keys[key], cache)
+                    caches[key] = []
+
+            for key, cache in caches.items():
+                if cache:
+                    written.add(key)
+                    cls._write_tmp(redis_client, tmp_keys[key], cache)
+        except Exception:
+            # 修正失败时删除已写入的临时键
+            for key in written:
+                redis_client.delete(tmp_keys[key])
+            raise
+
+        for key, tmp_key in tmp_keys.items():
+            if key in written:
+                redis_client.eval(RENAME_PERSIST_SCRIPT, 2, tmp_key, key)
+            else:
+                redis_client.delete(key)
+
+        # 分片已是数据库中的最新数据，未迁移的旧数据不再需要
+        if cls._sharded():
+            current_app.redis_master.delete(cls.key)
+
+        return rows
+
+    @staticmethod
+    def _write_tmp(redis_client, tmp_key, cache):
+        # 临时键设置过期时间，进程在修正中途被杀死时不会残留
+        pl = redis_client.pipeline(transaction=False)
+        pl.zadd(tmp_key, *cache)
+        pl.expire(tmp_key, constants.COUNT_STORAGE_RESET_TMP_TTL)
+        pl.execute()
+
+    @classmethod
+    def db_query_changed(cls, since):
+        """
+        查询数据在since之后有变化的统计对象id
+        """
+        return db.session.query(cls.id_column).filter(cls.update_column >= since).distinct()
+
+    @classmethod
+    def patch(cls, counts):
+        """
+        只更新指定id的统计数据，增量修正时使用
+        :param counts: {id: count}，数量为0的从有序集合中删除
+        :return: 更新的数据条数
+        """
+        redis_client = cls._write_client()  # type: StrictRedis
+        pl = redis_client.pipeline(transaction=False)
+        for member, count in counts.items():
+            key = cls._key_for(member)
+            if count:
+                pl.zadd(key, count, member)
+            else:
+                pl.zrem(key, member)
+        pl.execute()
+        return len(counts)
+
+    @classmethod
+    def migrate(cls):
+        """
+        将未分片的旧有序集合迁移到分片中
+        先将旧键RENAME为本次迁移独占的键，迁移期间的新增量已写入分片，因此旧数据使用ZINCRBY累加
+        每个成员累加时在同一槽位记录迁移标记，中断后继续迁移或多个进程同时迁移时每个成员只累加一次
+        全量修正会以数据库结果覆盖分片并删除旧键，之后再执行不做任何处理
+        """
+        if not cls._sharded():
+            return
+
         redis_master = current_app.redis_master  # type: StrictRedis
 
-        pipeline = redis_master.pipeline()
-        pipeline.delete(cls.key)
-        for user_id, count in result:
-            pipeline.zadd(cls.key, count, user_id)
-        pipeline.execute()
+        # 之前中断的迁移
+        claimed = [key.decode() for key in redis_master.scan_iter(match='{}:migrating:*'.format(cls.key))]
+
+        claim_key = '{}:migrating:{}'.format(cls.key, uuid.uuid4().hex)
+        try:
+            redis_master.rename(cls.key, claim_key)
+            claimed.append(claim_key)
+        except ResponseError:
+            # 旧键不存在
+            pass
+
+        for claim_key in claimed:
+            cls._migrate_claimed(claim_key)
+
+    @classmethod
+    def _migrate_claimed(cls, claim_key):
+        redis_master = current_app.redis_master  # type: StrictRedis
+        redis_client = cls._write_client()  # type: StrictRedis
+        claim_id = claim_key.rsplit(':', 1)[1]
+
+        cursor = 0
+        while True:
+            cursor, items = redis_master.zscan(claim_key, cursor, count=constants.COUNT_STORAGE_RESET_CHUNK_SIZE)
+            shards = defaultdict(list)
+            for member, score in items:
+                key = cls._key_for(int(member))
+                shards[key].append(int(member))
+                shards[key].append(score)
+            for key, args in shards.items():
+                redis_client.eval(MIGRATE_MEMBERS_SCRIPT, 2, key, '{}:migrated:{}'.format(key, claim_id),
+                                  constants.COUNT_STORAGE_MIGRATE_MARKER_TTL, *args)
+            if cursor == 0:
+                break
+
+        redis_master.delete(claim_key)
 
 
 class UserArticleCountStorage(BaseCountStorage):
     """用户发布的文章数量统计"""
     key = "count:user:articles"
 
+    # 文章表的更新时间不会随审核状态变化而更新，无法增量修正，定期全量修正
+
     @staticmethod
     def db_query():
         result = db.session.query(Article.user_id, func.count(Article.id)) \
             .filter(Article.status == Article.STATUS.APPROVED) \
-            .group_by(Article.user_id).all()
+            .group_by(Article.user_id)
 
         return result
 
@@ -72,7 +430,7 @@ class UserArticleLikingCountStorage(BaseCountStorage):
     @staticmethod
     def db_query():
         ret = db.session.query(Attitude.article_id, func.count(Collection.article_id)) \
-            .filter(Attitude.attitude == Attitude.ATTITUDE.LIKING).group_by(Collection.article_id).all()
+            .filter(Attitude.attitude == Attitude.ATTITUDE.LIKING).group_by(Collection.article_id)
         return ret
 
 
@@ -84,11 +442,14 @@ class UserFollowingsCountStorage(BaseCountStorage):
     """
     key = 'count:user:followings'
 
+    id_column = Relation.user_id
+    update_column = Relation.utime
+
     @staticmethod
     def db_query():
         return db.session.query(Relation.user_id, func.count(Relation.target_user_id)) \
             .filter(Relation.relation == Relation.RELATION.FOLLOW) \
-            .group_by(Relation.user_id).all()
+            .group_by(Relation.user_id)
 
 
 class UserArticleCollectingCountStorage(BaseCountStorage):
@@ -97,10 +458,13 @@ class UserArticleCollectingCountStorage(BaseCountStorage):
     """
     key = 'count:user:art:collecting'
 
+    id_column = Collection.user_id
+    update_column = Collection.utime
+
     @staticmethod
     def db_query():
         ret = db.session.query(Collection.user_id, func.count(Collection.article_id)) \
-            .filter(Collection.is_deleted == 0).group_by(Collection.user_id).all()
+            .filter(Collection.is_deleted == 0).group_by(Collection.user_id)
         return ret
 
 
@@ -113,7 +477,7 @@ class ArticleDislikeCountStorage(BaseCountStorage):
     @staticmethod
     def db_query():
         ret = db.session.query(Attitude.article_id, func.count(Collection.article_id)) \
-            .filter(Attitude.attitude == Attitude.ATTITUDE.DISLIKE).group_by(Collection.article_id).all()
+            .filter(Attitude.attitude == Attitude.ATTITUDE.DISLIKE).group_by(Collection.article_id)
         return ret
 
 
@@ -122,11 +486,17 @@ class CommentLikingCountStorage(BaseCountStorage):
     评论点赞数据
     """
     key = 'count:comm:liking'
+    BUFFERED = True
+    SHARDS = 16
+    CLUSTER = True
+
+    id_column = CommentLiking.comment_id
+    update_column = CommentLiking.utime
 
     @staticmethod
     def db_query():
         ret = db.session.query(CommentLiking.comment_id, func.count(CommentLiking.comment_id)) \
-            .filter(CommentLiking.is_deleted == 0).group_by(CommentLiking.comment_id).all()
+            .filter(CommentLiking.is_deleted == 0).group_by(CommentLiking.comment_id)
         return ret
 
 
@@ -135,11 +505,16 @@ class ArticleCommentCountStorage(BaseCountStorage):
     文章评论数量
     """
     key = 'count:art:comm'
+    BUFFERED = True
+    SHARDS = 16
+    CLUSTER = True
+
+    # 评论表没有更新时间，审核状态的变化无法增量发现，定期全量修正
 
     @staticmethod
     def db_query():
         ret = db.session.query(Comment.article_id, func.count(Comment.id)) \
-            .filter(Comment.status == Comment.STATUS.APPROVED).group_by(Comment.article_id).all()
+            .filter(Comment.status == Comment.STATUS.APPROVED).group_by(Comment.article_id)
         return ret
 
 
@@ -148,12 +523,16 @@ class CommentReplyCountStorage(BaseCountStorage):
     评论回复数量
     """
     key = 'count:art:reply'
+    SHARDS = 16
+    CLUSTER = True
+
+    # 评论表没有更新时间，审核状态的变化无法增量发现，定期全量修正
 
     @staticmethod
     def db_query():
         ret = db.session.query(Comment.parent_id, func.count(Comment.id)) \
             .filter(Comment.status == Comment.STATUS.APPROVED, Comment.parent_id != None) \
-            .group_by(Comment.parent_id).all()
+            .group_by(Comment.parent_id)
         return ret
 
 
@@ -163,11 +542,14 @@ class UserFollowersCountStorage(BaseCountStorage):
     """
     key = 'count:user:followers'
 
+    id_column = Relation.target_user_id
+    update_column = Relation.utime
+
     @staticmethod
     def db_query():
         ret = db.session.query(Relation.target_user_id, func.count(Relation.user_id)) \
             .filter(Relation.relation == Relation.RELATION.FOLLOW) \
-            .group_by(Relation.target_user_id).all()
+            .group_by(Relation.target_user_id)
         return ret
 
 
@@ -177,13 +559,21 @@ class UserLikedCountStorage(BaseCountStorage):
     """
     key = 'count:user:liked'
 
+    id_column = Article.user_id
+    update_column = Attitude.utime
+
     @staticmethod
     def db_query():
         ret = db.session.query(Article.user_id, func.count(Attitude.id)).join(Attitude.article) \
             .filter(Attitude.attitude == Attitude.ATTITUDE.LIKING) \
-            .group_by(Article.user_id).all()
+            .group_by(Article.user_id)
         return ret
 
+    @classmethod
+    def db_query_changed(cls, since):
+        return db.session.query(Article.user_id).join(Attitude.article) \
+            .filter(Attitude.utime >= since).distinct()
+
 
 class ArticleReadingCountStorage(BaseCountStorage):
     """
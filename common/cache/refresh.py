@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import constants
+from . import singleflight
+
+
+class RefreshPool(object):
+    """
+    缓存后台刷新线程池
+    排队任务数有上限，同一个键同时只有一个刷新任务
+    """
+
+    def __init__(self, max_workers=constants.CACHE_REFRESH_POOL_MAX_WORKERS,
+                 max_pending=constants.CACHE_REFRESH_POOL_MAX_PENDING):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cache-refresh')
+        self._semaphore = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, app, key, func):
+        """
+        提交刷新任务
+        :param app: Flask app对象
+        :param key: 缓存键
+        :param func: 刷新函数
+        :return: 是否已提交
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            if not self._semaphore.acquire(blocking=False):
+                return False
+            self._pending.add(key)
+
+        self._executor.submit(self._run, app, key, func)
+        return True
+
+    def _run(self, app, key, func):
+        try:
+            with app.app_context():
+                func()
+        except Exception as e:
+            app.logger.error(e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+            self._semaphore.release()
+
+
+def refresh_in_background(key, save, decode, seen):
+    """
+    在后台刷新已软过期的缓存，当前请求直接使用旧数据
+    其他进程的一级缓存中仍是旧数据，刷新前先确认redis中的数据仍是本进程读到的旧数据，已被其他进程刷新时只删除一级缓存
+    :param key: 缓存键
+    :param save: 查询数据库并回填缓存的函数
+    :param decode: 将redis中的缓存原始数据转换为与save相同返回格式的函数
+    :param seen: 当前请求读取到的缓存原始数据
+    """
+    def refresh():
+        try:
+            current = current_app.redis_cluster.get(key)
+        except RedisError as e:
+            current_app.logger.error(e)
+            return
+
+        if current is not None and current != seen:
+            current_app.local_cache.delete(key)
+            return
+
+        singleflight.rebuild(key, save, decode)
+
+    app = current_app._get_current_object()
+    app.cache_refresh_pool.submit(app, key, refresh)
@@ -0,0 +1,126 @@
+import threading
+import time
+import uuid
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import constants
+
+
+# 仅当锁仍属于自己时才删除，防止误删其他进程在锁过期后获取的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class _Call(object):
+    """
+    一次正在进行的重建
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    进程内请求合并，同一个键同时只有一个线程执行，其他线程等待并共享其结果
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        执行
+        :param key: 合并的键
+        :param func: 执行函数
+        :return: func的返回值
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+
+_single_flight = SingleFlight()
+
+
+def _rebuild_with_lock(key, save, decode):
+    """
+    跨进程合并，通过redis短锁保证同一时刻只有一个进程查询数据库
+    未获取到锁的进程在有限时间内轮询缓存，超时后自行查询数据库
+    """
+    rc = current_app.redis_cluster
+    lock_key = 'lock:{}'.format(key)
+    token = uuid.uuid4().hex
+
+    try:
+        locked = rc.set(lock_key, token, nx=True, px=constants.REBUILD_LOCK_TTL)
+    except RedisError as e:
+        current_app.logger.error(e)
+        return save()
+
+    if locked:
+        try:
+            return save()
+        finally:
+            try:
+                rc.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            except RedisError as e:
+                current_app.logger.error(e)
+
+    deadline = time.monotonic() + constants.REBUILD_LOCK_WAIT
+    while True:
+        try:
+            ret = rc.get(key)
+        except RedisError as e:
+            current_app.logger.error(e)
+            break
+        # 提前刷新时旧缓存仍然存在，可直接使用
+        if ret is not None:
+            return decode(ret)
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(constants.REBUILD_LOCK_POLL_INTERVAL)
+
+    return save()
+
+
+def rebuild(key, save, decode):
+    """
+    合并缓存缺失后的重建，防止热点键过期时大量请求同时查询数据库
+    :param key: 缓存键
+    :param save: 查询数据库并回填缓存的函数，返回缓存数据
+    :param decode: 将redis中的缓存原始数据转换为与save相同返回格式的函数
+    :return: 缓存数据
+    """
+    return _single_flight.do(key, lambda: _rebuild_with_lock(key, save, decode))
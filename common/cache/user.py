@@ -1,13 +1,20 @@
-import json
 import time
+from datetime import datetime
 
 from flask import current_app, g
 from redis import StrictRedis
-from redis.exceptions import RedisError
+from redis.exceptions import RedisError, ResponseError
+from sqlalchemy import or_, and_
 from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm import load_only
 
+from cache import bloom
+from cache import codec
 from cache import persstorage as cache_statistic
+from cache import refresh
+from cache import singleflight
+from cache import xfetch
+from models import db
 from models.news import Article, Collection, Attitude, CommentLiking
 from models.user import User, Relation, UserProfile
 from . import constants
@@ -22,10 +29,33 @@ class UserProfileCache(object):
         self.key = 'user:{}:profile'.format(user_id)
         self.user_id = user_id
 
+    @staticmethod
+    def _decode(cache_data):
+        """
+        解析缓存数据，-1标识表示用户不存在
+        """
+        return None if cache_data == b'-1' else xfetch.loads(cache_data)[0]
+
+    @staticmethod
+    def _format(user):
+        """
+        组织用户缓存数据
+        """
+        return {
+            'name': user.name,
+            'mobile': user.mobile,
+            'profile_photo': user.profile_photo,
+            'certificate': user.certificate,
+            'introduction': user.introduction
+        }
+
     def save(self):
         # 1、查询缓存redis缓存
         redis_cluster = current_app.redis_cluster
 
+        # 记录重建耗时，用于提前过期判断
+        start = time.monotonic()
+
         try:
             user = User.query.options(load_only(
                 User.name,
@@ -39,16 +69,11 @@ class UserProfileCache(object):
             raise e
 
         if user:
-            user_dict = {
-                'name': user.name,
-                'mobile': user.mobile,
-                'profile_photo': user.profile_photo,
-                'certificate': user.certificate,
-                'introduction': user.introduction
-            }
-            user_str = json.dumps(user_dict)
+            user_dict = self._format(user)
+            ttl = constants.UserProfileCacheTTL.get_time()
+            user_str = xfetch.dumps(user_dict, time.monotonic() - start, ttl)
 
-            redis_cluster.setex(self.key, constants.UserProfileCacheTTL.get_time(), user_str)
+            redis_cluster.setex(self.key, xfetch.hard_time(constants.UserProfileCacheTTL, ttl), user_str)
             # 4、mysql有值，返回并回填
             return user_dict
 
@@ -71,11 +96,102 @@ class UserProfileCache(object):
         if cache_data:
             if cache_data == b'-1':
                 return None
-            else:
-                return json.loads(cache_data)
-        # 3、无值，查询mysql
+
+            user_dict, delta, expiry = xfetch.loads(cache_data)
+            if constants.UserProfileCacheTTL.is_stale(expiry) \
+                    or constants.UserProfileCacheTTL.should_refresh(delta, expiry):
+                # 已软过期或临近过期时按概率提前刷新，使用当前数据并在后台刷新，请求中不查询数据库
+                refresh.refresh_in_background(self.key, self.save, self._decode, cache_data)
+            return user_dict
+        # 布隆过滤器判断用户一定不存在，不再查询数据库
+        elif not bloom.UserBloomFilter.might_contain(self.user_id):
+            return None
+        # 3、无值，查询mysql，合并并发的缓存重建
         else:
-            return self.save()
+            return singleflight.rebuild(self.key, self.save, self._decode)
+
+    @classmethod
+    def get_many(cls, user_ids):
+        """
+        批量获取用户缓存数据
+        缓存通过一次集群管道读取，缺失的用户使用一次IN查询并通过一次管道回填
+        :param user_ids: [user_id, ...]
+        :return: {user_id: user_dict}，不存在的用户为None
+        """
+        redis_cluster = current_app.redis_cluster
+
+        try:
+            pl = redis_cluster.pipeline()
+            for user_id in user_ids:
+                pl.get(cls(user_id).key)
+            caches = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            caches = [None] * len(user_ids)
+
+        users = {}
+        need_db_query = []
+        for user_id, cache_data in zip(user_ids, caches):
+            if cache_data is None:
+                need_db_query.append(user_id)
+            elif cache_data == b'-1':
+                users[user_id] = None
+            else:
+                user_dict, delta, expiry = xfetch.loads(cache_data)
+                users[user_id] = user_dict
+                if constants.UserProfileCacheTTL.is_stale(expiry) \
+                        or constants.UserProfileCacheTTL.should_refresh(delta, expiry):
+                    # 已软过期或临近过期时按概率提前刷新，使用当前数据并在后台刷新
+                    cache = cls(user_id)
+                    refresh.refresh_in_background(cache.key, cache.save, cls._decode, cache_data)
+
+        # 布隆过滤器判断一定不存在的用户，不再查询数据库
+        exists = bloom.UserBloomFilter.might_contain_many(need_db_query)
+        for user_id, user_exists in zip(need_db_query, exists):
+            if not user_exists:
+                users[user_id] = None
+        need_db_query = [user_id for user_id, user_exists in zip(need_db_query, exists) if user_exists]
+
+        if not need_db_query:
+            return users
+
+        start = time.monotonic()
+        try:
+            ret = User.query.options(load_only(
+                User.id,
+                User.name,
+                User.mobile,
+                User.profile_photo,
+                User.certificate,
+                User.introduction
+            )).filter(User.id.in_(need_db_query)).all()
+        except DatabaseError as e:
+            current_app.logger.error(e)
+            raise e
+        delta = time.monotonic() - start
+
+        db_users = {user.id: user for user in ret}
+
+        # 批量回填，不存在的用户回填-1标识
+        pl = redis_cluster.pipeline()
+        for user_id in need_db_query:
+            user = db_users.get(int(user_id))
+            if user:
+                user_dict = cls._format(user)
+                ttl = constants.UserProfileCacheTTL.get_time()
+                pl.setex(cls(user_id).key, xfetch.hard_time(constants.UserProfileCacheTTL, ttl),
+                         xfetch.dumps(user_dict, delta, ttl))
+                users[user_id] = user_dict
+            else:
+                pl.setex(cls(user_id).key, constants.UserNotExistsCacheTTL.get_time(), '-1')
+                users[user_id] = None
+
+        try:
+            pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+
+        return users
 
     def clear(self):
         '''清除缓存'''
@@ -104,8 +220,10 @@ class UserProfileCache(object):
                 return False
             else:
                 return True
+        elif not bloom.UserBloomFilter.might_contain(self.user_id):
+            return False
         else:
-            result = self.save()
+            result = singleflight.rebuild(self.key, self.save, self._decode)
             if result:
                 return True
             else:
@@ -130,7 +248,7 @@ class UserStatusCache(object):
         """
 
         try:
-            current_app.redis_cluster.setex(self.key, constants.UserStatusCacheTTL.get_val(), status)
+            current_app.redis_cluster.setex(self.key, constants.UserStatusCacheTTL.get_time(), status)
         except RedisError as e:
             current_app.logger.error(e)
 
@@ -181,7 +299,7 @@ class UserAdditionalProfileCache(object):
             ret = None
 
         if ret:
-            return json.loads(ret)
+            return codec.loads(ret)
         else:
             profile = UserProfile.query.options(load_only(UserProfile.gender, UserProfile.birthday)) \
                 .filter_by(id=self.user_id).first()
@@ -190,7 +308,7 @@ class UserAdditionalProfileCache(object):
                 'birthday': profile.birthday.strftime('%Y-%m-%d') if profile.birthday else ''
             }
             try:
-                rc.setex(self.key, constants.UserAdditionalProfileCacheTTL.get_val(), json.dumps(profile_dict))
+                rc.setex(self.key, constants.UserAdditionalProfileCacheTTL.get_time(), codec.dumps(profile_dict))
             except RedisError as e:
                 current_app.logger.error(e)
             return profile_dict
@@ -252,7 +370,7 @@ class UserFollowingCache(object):
             try:
                 pl = rc.pipeline()
                 pl.zadd(self.key, *cache)
-                pl.expire(self.key, constants.UserFollowingsCacheTTL.get_val())
+                pl.expire(self.key, constants.UserFollowingsCacheTTL.get_time())
                 results = pl.execute()
                 if results[0] and not results[1]:
                     rc.delete(self.key)
@@ -267,9 +385,34 @@ class UserFollowingCache(object):
         :param target_user_id: 被关注的用户id
         :return:
         """
-        followings = self.get()
+        target_user_id = int(target_user_id)
+        return self.determine_follows_targets([target_user_id])[target_user_id]
 
-        return int(target_user_id) in followings
+    def determine_follows_targets(self, target_user_ids):
+        """
+        批量判断用户是否关注了目标用户
+        缓存存在时通过一次管道ZSCORE判断，缓存不存在时才重建完整的关注列表
+        :param target_user_ids: [target_user_id, ...]
+        :return: {target_user_id: bool}
+        """
+        target_user_ids = [int(target_user_id) for target_user_id in target_user_ids]
+        rc = current_app.redis_cluster
+
+        try:
+            pl = rc.pipeline()
+            pl.exists(self.key)
+            for target_user_id in target_user_ids:
+                pl.zscore(self.key, target_user_id)
+            ret = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            ret = None
+
+        if ret and ret[0]:
+            return {target_user_id: score is not None for target_user_id, score in zip(target_user_ids, ret[1:])}
+
+        followings = set(self.get())
+        return {target_user_id: target_user_id in followings for target_user_id in target_user_ids}
 
     def update(self, target_user_id, timestamp, increment=1):
         """
@@ -335,10 +478,10 @@ class UserRelationshipCache(object):
         try:
             if relations:
                 pl.hmset(self.key, relations)
-                pl.expire(self.key, constants.UserFollowingsCacheTTL.get_val())
+                pl.expire(self.key, constants.UserFollowingsCacheTTL.get_time())
             else:
                 pl.hmset(self.key, {-1: -1})
-                pl.expire(self.key, constants.UserRelationshipNotExistsCacheTTL.get_val())
+                pl.expire(self.key, constants.UserRelationshipNotExistsCacheTTL.get_time())
             results = pl.execute()
             if results[0] and not results[1]:
                 rc.delete(self.key)
@@ -347,15 +490,46 @@ class UserRelationshipCache(object):
 
         return relations
 
+    def get_relations(self, target_user_ids):
+        """
+        批量获取用户与目标用户的关系
+        缓存存在时通过一次HMGET只获取目标用户的关系，缓存不存在时才重建完整的关系数据
+        :param target_user_ids: [target_user_id, ...]
+        :return: {target_user_id: relation}，没有关系的为None
+        """
+        target_user_ids = [int(target_user_id) for target_user_id in target_user_ids]
+        if not target_user_ids:
+            return {}
+
+        rc = current_app.redis_cluster
+
+        try:
+            pl = rc.pipeline()
+            pl.exists(self.key)
+            pl.hmget(self.key, target_user_ids)
+            exists, ret = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            exists, ret = False, None
+
+        if exists:
+            # 不存在关系数据时缓存中只有{-1: -1}，HMGET结果均为None
+            return {target_user_id: int(relation) if relation is not None else None
+                    for target_user_id, relation in zip(target_user_ids, ret)}
+
+        relations = self.get()
+        return {target_user_id: relations.get(target_user_id) for target_user_id in target_user_ids}
+
     def determine_follows_target(self, target_user_id):
         """
         判断用户是否关注了目标用户
         :param target_user_id: 被关注的用户id
         :return:
         """
-        relations = self.get()
+        target_user_id = int(target_user_id)
+        relations = self.get_relations([target_user_id])
 
-        return relations.get(target_user_id) == Relation.RELATION.FOLLOW
+        return relations[target_user_id] == Relation.RELATION.FOLLOW
 
     def determine_blacklist_target(self, target_user_id):
         """
@@ -363,9 +537,10 @@ class UserRelationshipCache(object):
         :param target_user_id:
         :return:
         """
-        relations = self.get()
+        target_user_id = int(target_user_id)
+        relations = self.get_relations([target_user_id])
 
-        return relations.get(target_user_id) == Relation.RELATION.BLACKLIST
+        return relations[target_user_id] == Relation.RELATION.BLACKLIST
 
     def clear(self):
         """
@@ -374,59 +549,213 @@ class UserRelationshipCache(object):
         current_app.redis_cluster.delete(self.key)
 
 
-class UserFollowersCache(object):
+class BaseUserListCache(object):
     """
-    用户粉丝缓存
+    用户列表缓存基类
+    有序集合以时间戳为分数，只保存最近的LIMIT条数据，超出时在末尾保存分数为0的截断标识，更早的数据使用键集分页查询数据库
+    列表按(时间戳, id)降序排列，游标为上一页最后一条的(时间戳, id)，时间只精确到秒，同一秒的数据以id区分
     """
+    key_format = ''
+    # 缓存保存的最大条数
+    LIMIT = constants.USER_LIST_CACHE_LIMIT
+    # 缓存被截断的标识
+    TRUNCATED = -1
+    # 缓存有效期
+    ttl = None
+    # 列表数量统计数据
+    count_storage = None
+    # 列表数据的id列
+    id_column = None
+    # 排序使用的时间列
+    time_column = None
+    # 关联用户id的列
+    user_column = None
+    # 其他查询条件
+    filters = ()
 
     def __init__(self, user_id):
-        self.key = 'user:{}:fans'.format(user_id)
         self.user_id = user_id
+        self.key = self.key_format.format(user_id)
 
-    def get(self):
+    def db_query(self):
         """
-        获取用户的粉丝列表
-        :return:
+        查询列表数据
+        :return: 查询(id, 时间)的query对象
+        """
+        return db.session.query(self.id_column, self.time_column) \
+            .filter(self.user_column == self.user_id, *self.filters)
+
+    @staticmethod
+    def _after_cursor(cursor, item_id, timestamp):
+        """
+        判断数据是否排在游标之后
+        """
+        if cursor is None:
+            return True
+        cursor_timestamp, cursor_id = cursor
+        return timestamp < cursor_timestamp or (timestamp == cursor_timestamp and item_id < cursor_id)
+
+    def _db_page(self, cursor, limit):
+        """
+        键集分页查询数据库，耗时与页数无关
+        :param cursor: (时间戳, id)，只查询排在此之后的数据，None表示从最新的开始
+        :return: [(id, timestamp), ...]
         """
+        query = self.db_query()
+        if cursor is not None:
+            cursor_time = datetime.fromtimestamp(cursor[0])
+            query = query.filter(or_(self.time_column < cursor_time,
+                                     and_(self.time_column == cursor_time, self.id_column < cursor[1])))
+        ret = query.order_by(self.time_column.desc(), self.id_column.desc()).limit(limit).all()
+        return [(item_id, item_time.timestamp()) for item_id, item_time in ret]
+
+    def _rebuild(self):
+        """
+        查询最近的LIMIT条数据并回填缓存
+        使用服务端游标分批读取，每批通过一条ZADD写入，避免大列表阻塞进程和产生过大的redis命令
+        :return: [(id, timestamp), ...], 是否被截断
+        """
+        # 为了防止缓存击穿，先尝试从缓存中判断数量是否为0，若为0不再查询数据库
+        if self.count_storage.get(self.user_id) == 0:
+            return [], False
+
         rc = current_app.redis_cluster
 
+        # 先写入截断标识，分批回填期间读取到不完整缓存的请求会继续查询数据库
         try:
-            ret = rc.zrevrange(self.key, 0, -1)
+            pl = rc.pipeline()
+            pl.zadd(self.key, 0, self.TRUNCATED)
+            pl.expire(self.key, self.ttl.get_time())
+            pl.execute()
         except RedisError as e:
             current_app.logger.error(e)
-            ret = None
 
-        if ret:
-            # In order to be consistent with db data type.
-            return [int(uid) for uid in ret]
-
-        ret = cache_statistic.UserFollowersCountStorage.get(self.user_id)
-        if ret == 0:
-            return []
+        query = self.db_query().order_by(self.time_column.desc(), self.id_column.desc()).limit(self.LIMIT + 1) \
+            .execution_options(stream_results=True).yield_per(constants.USER_LIST_CACHE_REBUILD_CHUNK_SIZE)
 
-        ret = Relation.query.options(load_only(Relation.user_id, Relation.utime)) \
-            .filter_by(target_user_id=self.user_id, relation=Relation.RELATION.FOLLOW) \
-            .order_by(Relation.utime.desc()).all()
-
-        followers = []
+        rows = []
         cache = []
-        for relation in ret:
-            followers.append(relation.user_id)
-            cache.append(relation.utime.timestamp())
-            cache.append(relation.user_id)
+        truncated = False
+        for item_id, item_time in query:
+            if len(rows) >= self.LIMIT:
+                truncated = True
+                continue
+
+            score = item_time.timestamp()
+            rows.append((item_id, score))
+            cache.append(score)
+            cache.append(item_id)
+            if len(cache) >= 2 * constants.USER_LIST_CACHE_REBUILD_CHUNK_SIZE:
+                self._save_chunk(cache)
+                cache = []
 
         if cache:
+            self._save_chunk(cache)
+
+        if not truncated:
             try:
-                pl = rc.pipeline()
-                pl.zadd(self.key, *cache)
-                pl.expire(self.key, constants.UserFansCacheTTL.get_val())
-                results = pl.execute()
-                if results[0] and not results[1]:
-                    rc.delete(self.key)
+                rc.zrem(self.key, self.TRUNCATED)
             except RedisError as e:
                 current_app.logger.error(e)
 
-        return followers
+        return rows, truncated
+
+    def _save_chunk(self, cache):
+        try:
+            current_app.redis_cluster.zadd(self.key, *cache)
+        except RedisError as e:
+            current_app.logger.error(e)
+
+    def _cache_page(self, cursor, limit):
+        """
+        从缓存中获取排在游标之后的至少limit条数据
+        同一分数的成员在redis中按字典序排列，与id的数值顺序不一致，因此可能被LIMIT截断的最后一组分数整组读取，再按(时间戳, id)降序排序
+        :return: 缓存是否存在, [(id, timestamp), ...], 是否被截断
+        """
+        rc = current_app.redis_cluster
+        max_score = cursor[0] if cursor is not None else '+inf'
+
+        pl = rc.pipeline()
+        pl.exists(self.key)
+        pl.zrevrangebyscore(self.key, max_score, '-inf', start=0, num=limit, withscores=True)
+        exists, ret = pl.execute()
+        if not exists:
+            return False, [], False
+
+        rows = []
+        truncated = False
+        while ret:
+            batch = [(int(item_id), score) for item_id, score in ret]
+            last_score = batch[-1][1]
+            full = len(batch) >= limit - len(rows)
+            if full:
+                group = rc.zrangebyscore(self.key, last_score, last_score)
+                batch = [row for row in batch if row[1] != last_score] + [(int(item_id), last_score) for item_id in group]
+
+            for item_id, score in sorted(batch, key=lambda row: (row[1], row[0]), reverse=True):
+                if item_id == self.TRUNCATED:
+                    truncated = True
+                elif self._after_cursor(cursor, item_id, score):
+                    rows.append((item_id, score))
+
+            # 游标所在的一组可能全部被过滤，继续读取更早的数据
+            if not full or len(rows) >= limit:
+                break
+            ret = rc.zrevrangebyscore(self.key, '({}'.format(last_score), '-inf', start=0, num=limit - len(rows),
+                                      withscores=True)
+
+        return True, rows, truncated
+
+    def get_page(self, per_page, cursor=None):
+        """
+        按游标分页获取列表
+        :param per_page: 每页数量
+        :param cursor: 上一页返回的游标(时间戳, id)，获取第一页时为None
+        :return: total_count, [id, ...], next_cursor，没有下一页时next_cursor为None
+        """
+        try:
+            exists, rows, truncated = self._cache_page(cursor, per_page + 1)
+        except RedisError as e:
+            current_app.logger.error(e)
+            exists, rows, truncated = False, [], False
+
+        if not exists:
+            # No cache.
+            rows, truncated = self._rebuild()
+            rows = [(item_id, timestamp) for item_id, timestamp in rows
+                    if self._after_cursor(cursor, item_id, timestamp)]
+
+        rows = rows[:per_page + 1]
+        if truncated and len(rows) <= per_page:
+            # 已读取到缓存末尾，更早的数据查询数据库
+            last_cursor = (rows[-1][1], rows[-1][0]) if rows else cursor
+            rows += self._db_page(last_cursor, per_page + 1 - len(rows))
+
+        next_cursor = (rows[per_page - 1][1], rows[per_page - 1][0]) if len(rows) > per_page else None
+        total_count = self.count_storage.get(self.user_id)
+
+        return total_count, [item_id for item_id, timestamp in rows[:per_page]], next_cursor
+
+    def clear(self):
+        """
+        清除
+        """
+        current_app.redis_cluster.delete(self.key)
+
+
+class UserFollowersCache(BaseUserListCache):
+    """
+    用户粉丝缓存
+    只保存最近的粉丝，更早的粉丝使用键集分页查询user_relation
+    """
+    key_format = 'user:{}:fans'
+    LIMIT = constants.USER_FOLLOWERS_CACHE_LIMIT
+    ttl = constants.UserFansCacheTTL
+    count_storage = cache_statistic.UserFollowersCountStorage
+    id_column = Relation.user_id
+    time_column = Relation.utime
+    user_column = Relation.target_user_id
+    filters = (Relation.relation == Relation.RELATION.FOLLOW,)
 
     def update(self, target_user_id, timestamp, increment=1):
         """
@@ -529,147 +858,83 @@ class UserSearchingHistoryStorage(object):
         current_app.redis_master.delete(self.key)
 
 
-class UserArticlesCache(object):
+class UserArticlesCache(BaseUserListCache):
     """
     用户文章缓存
     """
+    key_format = 'user:{}:art'
+    ttl = constants.UserArticlesCacheTTL
+    count_storage = cache_statistic.UserArticleCountStorage
+    id_column = Article.id
+    time_column = Article.ctime
+    user_column = Article.user_id
+    filters = (Article.status == Article.STATUS.APPROVED,)
 
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.key = 'user:{}:art'.format(user_id)
-
-    def get_page(self, page, per_page):
-        """
-        获取用户的文章列表
-        :param page: 页数
-        :param per_page: 每页数量
-        :return: total_count, [article_id, ..]
-        """
-        rc = current_app.redis_cluster
-
-        try:
-            pl = rc.pipeline()
-            pl.zcard(self.key)
-            pl.zrevrange(self.key, (page - 1) * per_page, page * per_page)
-            total_count, ret = pl.execute()
-        except RedisError as e:
-            current_app.logger.error(e)
-            total_count = 0
-            ret = []
-
-        if total_count > 0:
-            # Cache exists.
-            return total_count, [int(aid) for aid in ret]
-        else:
-            # No cache.
-            total_count = cache_statistic.UserArticleCountStorage.get(self.user_id)
-            if total_count == 0:
-                return 0, []
-
-            ret = Article.query.options(load_only(Article.id, Article.ctime)) \
-                .filter_by(user_id=self.user_id, status=Article.STATUS.APPROVED) \
-                .order_by(Article.ctime.desc()).all()
-
-            articles = []
-            cache = []
-            for article in ret:
-                articles.append(article.id)
-                cache.append(article.ctime.timestamp())
-                cache.append(article.id)
-
-            if cache:
-                try:
-                    pl = rc.pipeline()
-                    pl.zadd(self.key, *cache)
-                    pl.expire(self.key, constants.UserArticlesCacheTTL.get_val())
-                    results = pl.execute()
-                    if results[0] and not results[1]:
-                        rc.delete(self.key)
-                except RedisError as e:
-                    current_app.logger.error(e)
-
-            total_count = len(articles)
-            page_articles = articles[(page - 1) * per_page:page * per_page]
-
-            return total_count, page_articles
 
-    def clear(self):
-        """
-        清除
-        """
-        rc = current_app.redis_cluster
-        rc.delete(self.key)
-
-
-class UserArticleCollectionsCache(object):
+class UserArticleCollectionsCache(BaseUserListCache):
     """
     用户收藏文章缓存
     """
+    key_format = 'user:{}:art:collection'
+    ttl = constants.UserArticleCollectionsCacheTTL
+    count_storage = cache_statistic.UserArticleCollectingCountStorage
+    id_column = Collection.article_id
+    time_column = Collection.utime
+    user_column = Collection.user_id
+    filters = (Collection.is_deleted == False,)
+
+    def _db_collected(self, article_ids):
+        """
+        查询数据库判断是否收藏，用于缓存被截断时判断更早的收藏
+        :return: 已收藏的文章id集合
+        """
+        if not article_ids:
+            return set()
+        ret = self.db_query().filter(Collection.article_id.in_(article_ids)).all()
+        return {article_id for article_id, utime in ret}
 
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.key = 'user:{}:art:collection'.format(user_id)
-
-    def get_page(self, page, per_page):
+    def are_collected(self, article_ids):
         """
-        获取用户的文章列表
-        :param page: 页数
-        :param per_page: 每页数量
-        :return: total_count, [article_id, ..]
+        批量判断用户是否收藏了指定文章
+        缓存存在时通过一次管道ZSCORE判断，缓存不存在时才查询数据库重建
+        :param article_ids: [article_id, ...]
+        :return: {article_id: bool}
         """
+        article_ids = [int(article_id) for article_id in article_ids]
         rc = current_app.redis_cluster
 
         try:
             pl = rc.pipeline()
-            pl.zcard(self.key)
-            pl.zrevrange(self.key, (page - 1) * per_page, page * per_page)
-            total_count, ret = pl.execute()
+            pl.exists(self.key)
+            pl.zscore(self.key, self.TRUNCATED)
+            for article_id in article_ids:
+                pl.zscore(self.key, article_id)
+            ret = pl.execute()
         except RedisError as e:
             current_app.logger.error(e)
-            total_count = 0
-            ret = []
+            ret = None
 
-        if total_count > 0:
-            # Cache exists.
-            return total_count, [int(aid) for aid in ret]
+        if ret and ret[0]:
+            truncated = ret[1] is not None
+            collected = {article_id for article_id, score in zip(article_ids, ret[2:]) if score is not None}
         else:
-            # No cache.
-            total_count = cache_statistic.UserArticleCollectingCountStorage.get(self.user_id)
-            if total_count == 0:
-                return 0, []
-
-            ret = Collection.query.options(load_only(Collection.article_id, Collection.utime)) \
-                .filter_by(user_id=self.user_id, is_deleted=False) \
-                .order_by(Collection.utime.desc()).all()
-
-            collections = []
-            cache = []
-            for collection in ret:
-                collections.append(collection.article_id)
-                cache.append(collection.utime.timestamp())
-                cache.append(collection.article_id)
-
-            if cache:
-                try:
-                    pl = rc.pipeline()
-                    pl.zadd(self.key, *cache)
-                    pl.expire(self.key, constants.UserArticleCollectionsCacheTTL.get_val())
-                    results = pl.execute()
-                    if results[0] and not results[1]:
-                        rc.delete(self.key)
-                except RedisError as e:
-                    current_app.logger.error(e)
-
-            total_count = len(collections)
-            page_articles = collections[(page - 1) * per_page:page * per_page]
-
-            return total_count, page_articles
+            rows, truncated = self._rebuild()
+            collected = {article_id for article_id, score in rows}
 
-    def clear(self):
+        if truncated:
+            # 缓存只保存了最近的收藏，其余文章查询数据库
+            collected |= self._db_collected([article_id for article_id in article_ids if article_id not in collected])
+
+        return {article_id: article_id in collected for article_id in article_ids}
+
+    def is_collected(self, article_id):
         """
-        清除
+        判断用户是否收藏了指定文章
+        :param article_id:
+        :return:
         """
-        current_app.redis_cluster.delete(self.key)
+        article_id = int(article_id)
+        return self.are_collected([article_id])[article_id]
 
     def determine_collect_target(self, target):
         """
@@ -677,8 +942,7 @@ class UserArticleCollectionsCache(object):
         :param target:
         :return:
         """
-        total_count, collections = self.get_page(1, -1)
-        return target in collections
+        return self.is_collected(target)
 
 
 class UserArticleAttitudeCache(object):
@@ -722,10 +986,10 @@ class UserArticleAttitudeCache(object):
         try:
             if attitudes:
                 pl.hmset(self.key, attitudes)
-                pl.expire(self.key, constants.UserArticleAttitudeCacheTTL.get_val())
+                pl.expire(self.key, constants.UserArticleAttitudeCacheTTL.get_time())
             else:
                 pl.hmset(self.key, {-1: -1})
-                pl.expire(self.key, constants.UserArticleAttitudeNotExistsCacheTTL.get_val())
+                pl.expire(self.key, constants.UserArticleAttitudeNotExistsCacheTTL.get_time())
             results = pl.execute()
             if results[0] and not results[1]:
                 rc.delete(self.key)
@@ -734,19 +998,73 @@ class UserArticleAttitudeCache(object):
 
         return attitudes
 
+    def ensure(self):
+        """
+        确保缓存存在，不存在时查询数据库重建，用于在等待其他耗时操作时提前准备
+        """
+        try:
+            exists = current_app.redis_cluster.exists(self.key)
+        except RedisError as e:
+            current_app.logger.error(e)
+            return
+
+        if not exists:
+            self.get_all()
+
+    def get_attitudes(self, article_ids):
+        """
+        批量获取指定文章的态度
+        缓存存在时通过一次HMGET只获取当前页文章的态度，缓存不存在时才重建完整的态度数据
+        :param article_ids: [article_id, ...]
+        :return: {article_id: attitude}，没有态度的为-1
+        """
+        article_ids = [int(article_id) for article_id in article_ids]
+        if not article_ids:
+            return {}
+
+        rc = current_app.redis_cluster
+
+        try:
+            pl = rc.pipeline()
+            pl.exists(self.key)
+            pl.hmget(self.key, article_ids)
+            exists, ret = pl.execute()
+        except RedisError as e:
+            current_app.logger.error(e)
+            exists, ret = False, None
+
+        if exists:
+            return {article_id: int(attitude) if attitude is not None else -1
+                    for article_id, attitude in zip(article_ids, ret)}
+
+        attitudes = self.get_all()
+        return {article_id: attitudes.get(article_id, -1) for article_id in article_ids}
+
     def get_article_attitude(self, article_id):
         """
         获取指定文章态度
         :param article_id:
         :return:
         """
-        if hasattr(g, 'article_attitudes'):
-            attitudes = g.article_attitudes
-        else:
-            attitudes = self.get_all()
-            g.article_attitudes = attitudes
+        article_id = int(article_id)
+        return self.prefetch([article_id])[article_id]
 
-        return attitudes.get(article_id, -1)
+    def prefetch(self, article_ids):
+        """
+        批量获取文章态度并保存到本次请求中，文章列表先对整页调用，之后逐篇判断时不再访问redis
+        :param article_ids: [article_id, ...]
+        :return: {article_id: attitude}，没有态度的为-1
+        """
+        article_ids = [int(article_id) for article_id in article_ids]
+        if not hasattr(g, 'article_attitudes'):
+            g.article_attitudes = {}
+
+        # 只缓存本次请求中查询过的文章
+        missing = [article_id for article_id in article_ids if article_id not in g.article_attitudes]
+        if missing:
+            g.article_attitudes.update(self.get_attitudes(missing))
+
+        return {article_id: g.article_attitudes[article_id] for article_id in article_ids}
 
     def determine_liking_article(self, article_id):
         """
@@ -763,6 +1081,10 @@ class UserArticleAttitudeCache(object):
         current_app.redis_cluster.delete(self.key)
 
 
+# redis服务器是否支持SMISMEMBER命令(6.2+)，不支持时首次执行会失败并改为逐个SISMEMBER
+_smismember_supported = True
+
+
 class UserCommentLikingCache(object):
     """
     用户评论点赞缓存数据
@@ -801,10 +1123,10 @@ class UserCommentLikingCache(object):
         try:
             if cids:
                 pl.sadd(self.key, *cids)
-                pl.expire(self.key, constants.UserCommentLikingCacheTTL.get_val())
+                pl.expire(self.key, constants.UserCommentLikingCacheTTL.get_time())
             else:
                 pl.sadd(self.key, -1)
-                pl.expire(self.key, constants.UserCommentLikingNotExistsCacheTTL.get_val())
+                pl.expire(self.key, constants.UserCommentLikingNotExistsCacheTTL.get_time())
             results = pl.execute()
             if results[0] and not results[1]:
                 rc.delete(self.key)
@@ -813,19 +1135,72 @@ class UserCommentLikingCache(object):
 
         return set(cids)
 
+    def determine_liking_comments(self, comment_ids):
+        """
+        批量判断是否对评论点赞
+        缓存存在时通过一次SMISMEMBER只判断当前页的评论，缓存不存在时才重建完整的点赞数据
+        :param comment_ids: [comment_id, ...]
+        :return: {comment_id: bool}
+        """
+        global _smismember_supported
+
+        comment_ids = [int(comment_id) for comment_id in comment_ids]
+        if not comment_ids:
+            return {}
+
+        rc = current_app.redis_cluster
+        use_smismember = _smismember_supported
+
+        try:
+            pl = rc.pipeline()
+            pl.exists(self.key)
+            if use_smismember:
+                pl.execute_command('SMISMEMBER', self.key, *comment_ids)
+            else:
+                for comment_id in comment_ids:
+                    pl.sismember(self.key, comment_id)
+            ret = pl.execute()
+        except RedisError as e:
+            # redis 6.2以下版本不支持SMISMEMBER，改为逐个SISMEMBER
+            if use_smismember and isinstance(e, ResponseError) and 'unknown command' in str(e).lower():
+                _smismember_supported = False
+                return self.determine_liking_comments(comment_ids)
+            current_app.logger.error(e)
+            ret = None
+
+        if ret and ret[0]:
+            flags = ret[1] if use_smismember else ret[1:]
+            return {comment_id: bool(flag) for comment_id, flag in zip(comment_ids, flags)}
+
+        liking_comments = self.get()
+        return {comment_id: comment_id in liking_comments for comment_id in comment_ids}
+
     def determine_liking_comment(self, comment_id):
         """
         判断是否对文章点赞
         :param comment_id:
         :return:
         """
-        if hasattr(g, self.key):
-            liking_comments = getattr(g, self.key)
-        else:
-            liking_comments = self.get()
-            setattr(g, self.key, liking_comments)
+        comment_id = int(comment_id)
+        return self.prefetch([comment_id])[comment_id]
+
+    def prefetch(self, comment_ids):
+        """
+        批量判断是否对评论点赞并保存到本次请求中，评论列表先对整页调用，之后逐条判断时不再访问redis
+        :param comment_ids: [comment_id, ...]
+        :return: {comment_id: bool}
+        """
+        comment_ids = [int(comment_id) for comment_id in comment_ids]
+        if not hasattr(g, self.key):
+            setattr(g, self.key, {})
+        liking_comments = getattr(g, self.key)
+
+        # 只缓存本次请求中查询过的评论
+        missing = [comment_id for comment_id in comment_ids if comment_id not in liking_comments]
+        if missing:
+            liking_comments.update(self.determine_liking_comments(missing))
 
-        return comment_id in liking_comments
+        return {comment_id: liking_comments[comment_id] for comment_id in comment_ids}
 
     def clear(self):
         """
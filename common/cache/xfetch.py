@@ -0,0 +1,57 @@
+import time
+
+from flask import current_app
+
+from . import codec
+
+
+# 附带重建耗时与过期时间的缓存数据标识
+ENVELOPE_FLAG = '__xfetch__'
+
+
+def enabled():
+    """
+    是否写入附带重建耗时与过期时间的缓存数据，由配置CACHE_XFETCH控制
+    旧版本会把附带信息的数据当作缓存数据本身，全部实例升级到能读取的版本后再开启
+    """
+    return current_app.config.get('CACHE_XFETCH', False)
+
+
+def hard_time(ttl_class, ttl):
+    """
+    redis中键的实际有效时长，未附带过期时间的数据不会软过期后刷新，按原有效期过期
+    :param ttl_class: 缓存有效期类
+    :param ttl: 缓存有效期，秒
+    """
+    return ttl_class.get_hard_time(ttl) if enabled() else ttl
+
+
+def dumps(data, delta, ttl):
+    """
+    序列化缓存数据，开启时同时保存重建耗时与过期时间，供读取时判断是否提前刷新
+    :param data: 缓存数据
+    :param delta: 重建缓存的耗时，秒
+    :param ttl: 缓存有效期，秒
+    :return: bytes
+    """
+    if not enabled():
+        return codec.dumps(data)
+
+    return codec.dumps({
+        ENVELOPE_FLAG: 1,
+        'data': data,
+        'delta': delta,
+        'expiry': time.time() + ttl
+    })
+
+
+def loads(raw):
+    """
+    反序列化缓存数据，兼容未附带重建耗时与过期时间的旧数据
+    :param raw: redis中的原始数据
+    :return: data, delta, expiry
+    """
+    value = codec.loads(raw)
+    if isinstance(value, dict) and ENVELOPE_FLAG in value:
+        return value['data'], value['delta'], value['expiry']
+    return value, None, None
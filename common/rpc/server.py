@@ -43,7 +43,11 @@ class UserArticleRecommendServicer(reco_pb2_grpc.UserArticleRecommendServicer):
 
 def server():
     # 通过grpc创建服务器对象
-    server = grpc.server(ThreadPoolExecutor(max_workers=10))
+    # 允许客户端通道池在空闲时每30秒发送keepalive ping
+    server = grpc.server(ThreadPoolExecutor(max_workers=10), options=[
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.min_ping_interval_without_data_ms', 20000),
+    ])
 
     # 将推荐文章服务加入到服务器对象中
     reco_pb2_grpc.add_UserArticleRecommendServicer_to_server(UserArticleRecommendServicer(), server)
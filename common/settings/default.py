@@ -52,7 +52,16 @@ class DefaultConfig(object):
     # rpc
 
     class RPC:
-        RECOMMEND = '127.0.0.1:8888'
+        # 推荐系统地址，可配置多个后端
+        RECOMMEND = ['127.0.0.1:8888']
+        # 推荐系统负载均衡方式 round_robin / least_outstanding
+        RECOMMEND_BALANCE = 'least_outstanding'
+        # 推荐请求的超时时间，秒
+        RECOMMEND_TIMEOUT = 0.5
+        # 推荐请求连续失败多少次后熔断，熔断期间使用降级文章列表
+        RECOMMEND_BREAKER_FAILURES = 5
+        # 熔断后多久重新尝试请求推荐系统，秒
+        RECOMMEND_BREAKER_RECOVERY = 30
         CHATBOT = '172.17.0.59:9999'
 
     # ES
@@ -83,6 +92,20 @@ class DefaultConfig(object):
     # TODO 调试后要修改
     CORS_ORIGINS = '*'
 
+    # 缓存数据编码格式 json / msgpack
+    # 读取时两种格式均支持，切换格式时先发布能读取新格式的版本，全部实例升级后再修改此配置
+    CACHE_CODEC = 'json'
+
+    # 文章、用户资料缓存是否附带重建耗时与过期时间，用于提前刷新与软过期
+    # 读取时两种格式均支持，全部实例升级到能读取的版本后再开启
+    CACHE_XFETCH = False
+
+    # 是否在返回文章列表后在后台预取下一页
+    FEED_PREFETCH = False
+
+    # 统计数据全量修正的执行时间(点)，None表示只进行增量修正
+    STATISTICS_FULL_FIX_HOUR = None
+
     # Snowflake ID Worker 参数
     DATACENTER_ID = 0
     WORKER_ID = 0
@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """
+    熔断器
+    连续失败达到阈值后打开，打开期间直接拒绝请求
+    超过恢复时间后放行一个试探请求，成功则关闭，失败则重新计时
+    试探请求超过恢复时间仍未记录结果时视为丢失，再放行新的试探请求
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        """
+        :param failure_threshold: 打开熔断器的连续失败次数
+        :param recovery_timeout: 打开后多久放行试探请求，秒
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        # 放行试探请求的时间点
+        self._trial_at = None
+
+    def allow(self):
+        """
+        判断是否允许请求
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            now = time.monotonic()
+            if now - self._opened_at < self.recovery_timeout:
+                return False
+
+            if self._trial_at is None or now - self._trial_at >= self.recovery_timeout:
+                self._trial_at = now
+                return True
+
+            return False
+
+    def record_success(self):
+        """
+        记录请求成功
+        """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def record_failure(self):
+        """
+        记录请求失败
+        """
+        with self._lock:
+            self._failures += 1
+            self._trial_at = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
@@ -0,0 +1,122 @@
+import itertools
+import threading
+import time
+
+import grpc
+
+
+class _Backend(object):
+    """
+    一个后端地址及其通道和健康状态
+    """
+
+    def __init__(self, target, options):
+        self.target = target
+        self.channel = grpc.insecure_channel(target, options=options)
+        # 进行中的请求数
+        self.outstanding = 0
+        # 连续失败次数
+        self.failures = 0
+        # 被摘除到的时间点
+        self.ejected_until = 0
+        # 通道连接状态
+        self.connectivity = None
+        self.channel.subscribe(self._on_connectivity, try_to_connect=True)
+
+    def _on_connectivity(self, connectivity):
+        self.connectivity = connectivity
+
+    def is_healthy(self, now):
+        if self.connectivity in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN):
+            return False
+        return now >= self.ejected_until
+
+
+class ChannelPool(object):
+    """
+    grpc通道池
+    每个后端地址一个开启了keepalive的通道，按轮询或最少进行中请求数选择后端
+    请求耗时很短，空闲时也发送keepalive以及时发现断开的连接
+    服务端需允许无请求时的ping且最小间隔不大于keepalive间隔(见rpc/server.py)，否则会以too_many_pings断开连接
+    连续失败或连接断开的后端暂时摘除，全部不健康时仍在所有后端中选择
+    """
+    ROUND_ROBIN = 'round_robin'
+    LEAST_OUTSTANDING = 'least_outstanding'
+
+    # 视为后端故障的错误，其他错误与后端健康无关
+    FAILURE_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                     grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.INTERNAL)
+
+    def __init__(self, targets, balance=LEAST_OUTSTANDING, keepalive_time_ms=30000,
+                 keepalive_timeout_ms=3000, failure_threshold=3, eject_time=10):
+        """
+        :param targets: 后端地址或地址列表
+        :param balance: 负载均衡方式
+        :param keepalive_time_ms: keepalive ping间隔，毫秒
+        :param keepalive_timeout_ms: keepalive ping超时，毫秒
+        :param failure_threshold: 连续失败多少次后摘除后端
+        :param eject_time: 摘除时长，秒
+        """
+        if isinstance(targets, str):
+            targets = [targets]
+
+        options = [
+            ('grpc.keepalive_time_ms', keepalive_time_ms),
+            ('grpc.keepalive_timeout_ms', keepalive_timeout_ms),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+        self.backends = [_Backend(target, options) for target in targets]
+        self.balance = balance
+        self.failure_threshold = failure_threshold
+        self.eject_time = eject_time
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def _pick(self):
+        now = time.monotonic()
+        backends = [backend for backend in self.backends if backend.is_healthy(now)] or self.backends
+
+        if self.balance == self.ROUND_ROBIN:
+            return backends[next(self._counter) % len(backends)]
+
+        # 进行中请求数相同时轮询，避免总是选中第一个
+        start = next(self._counter)
+        return min((backends[(start + i) % len(backends)] for i in range(len(backends))),
+                   key=lambda backend: backend.outstanding)
+
+    def future(self, stub_class, method, request, timeout=None):
+        """
+        选择后端发起异步请求
+        :param stub_class: grpc生成的Stub类
+        :param method: 方法名
+        :param request: 请求对象
+        :param timeout: 超时时间，秒
+        :return: grpc future对象
+        """
+        with self._lock:
+            backend = self._pick()
+            backend.outstanding += 1
+
+        stub = stub_class(backend.channel)
+        future = getattr(stub, method).future(request, timeout=timeout)
+        future.add_done_callback(lambda f: self._on_done(backend, f))
+        return future
+
+    def _on_done(self, backend, future):
+        failed = not future.cancelled() and future.code() in self.FAILURE_CODES
+
+        with self._lock:
+            backend.outstanding -= 1
+            if not failed:
+                backend.failures = 0
+                return
+
+            backend.failures += 1
+            if backend.failures >= self.failure_threshold:
+                backend.failures = 0
+                backend.ejected_until = time.monotonic() + self.eject_time
+
+    def close(self):
+        for backend in self.backends:
+            backend.channel.close()
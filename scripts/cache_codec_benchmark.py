@@ -0,0 +1,85 @@
+"""
+缓存编码格式对比：单个键的数据大小、redis内存占用与编解码耗时
+
+python scripts/cache_codec_benchmark.py
+python scripts/cache_codec_benchmark.py --redis 127.0.0.1:7000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+
+from cache import codec
+
+# 与各缓存类保存的数据结构一致的样例数据
+SAMPLES = {
+    'ArticleInfoCache': {
+        'id': 141330,
+        'title': 'Python 中的缓存编码格式对比',
+        'auth': 1155989075455377414,
+        'pubdate': '2019-03-11 09:00:00',
+        'channel_id': 1,
+        'comment_count': 12,
+        'allow_comment': True,
+        'like_count': 3021,
+        'article_count': 86
+    },
+    'UserProfileCache': {
+        'name': '黑马头条号',
+        'mobile': '13911111111',
+        'profile_photo': 'Fkj6tQi3xJwVXi1u2swCElotfdCi',
+        'certificate': '',
+        'introduction': '专注Python开发'
+    },
+    'CommentCache': {
+        'com_id': 1155989075455377414,
+        'aut_id': 1155612301347110912,
+        'pubdate': '2019-03-11T09:00:00',
+        'content': '写得很好，学习了',
+        'is_top': 0
+    },
+    'UserChannelsCache': [{'id': i, 'name': 'channel{}'.format(i)} for i in range(1, 12)],
+}
+
+NUMBER = 100000
+
+
+def bench(name, data, redis_client=None):
+    for codec_name in sorted(codec.CODECS):
+        raw = codec.dumps(data, codec_name)
+        encode_time = timeit.timeit(lambda: codec.dumps(data, codec_name), number=NUMBER)
+        decode_time = timeit.timeit(lambda: codec.loads(raw), number=NUMBER)
+
+        memory = '-'
+        if redis_client is not None:
+            key = 'bench:codec:{}:{}'.format(name, codec_name)
+            redis_client.set(key, raw)
+            memory = redis_client.execute_command('MEMORY', 'USAGE', key)
+            redis_client.delete(key)
+
+        print('{:<20}{:<10}{:>8}{:>12}{:>14.2f}{:>14.2f}'.format(
+            name, codec_name, len(raw), memory,
+            encode_time / NUMBER * 1e6, decode_time / NUMBER * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', help='host:port，用于统计MEMORY USAGE')
+    args = parser.parse_args()
+
+    redis_client = None
+    if args.redis:
+        from redis import StrictRedis
+        host, port = args.redis.split(':')
+        redis_client = StrictRedis(host=host, port=int(port))
+
+    print('{:<20}{:<10}{:>8}{:>12}{:>14}{:>14}'.format('cache', 'codec', 'bytes', 'memory', 'encode(us)', 'decode(us)'))
+    for name, data in SAMPLES.items():
+        bench(name, data, redis_client)
+
+
+if __name__ == '__main__':
+    main()
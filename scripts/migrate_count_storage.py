@@ -0,0 +1,38 @@
+"""
+将未分片的统计数据有序集合迁移到分片中，修正统计数据前会自动执行，也可在部署分片配置后手动执行
+
+python scripts/migrate_count_storage.py
+"""
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, BASE_DIR)
+
+from redis.sentinel import Sentinel
+from rediscluster import StrictRedisCluster
+
+from cache import persstorage
+from settings.default import DefaultConfig
+from toutiao import create_flask_app
+
+
+def main():
+    # 只初始化redis连接，不启动定时任务等
+    app = create_flask_app(DefaultConfig, enable_config_file=True)
+
+    _sentinel = Sentinel(app.config['REDIS_SENTINELS'])
+    app.redis_master = _sentinel.master_for(app.config['REDIS_SENTINEL_SERVICE_NAME'])
+    app.redis_slave = _sentinel.slave_for(app.config['REDIS_SENTINEL_SERVICE_NAME'])
+    app.redis_cluster = StrictRedisCluster(startup_nodes=app.config['REDIS_CLUSTER'])
+
+    with app.app_context():
+        for cls_name in persstorage.BaseCountStorage.__subclasses__():
+            if cls_name.SHARDS > 1 or cls_name.CLUSTER:
+                print('migrating {} ...'.format(cls_name.key))
+                cls_name.migrate()
+
+
+if __name__ == '__main__':
+    main()
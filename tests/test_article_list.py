@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+from cache import user as cache_user
+from settings.default import DefaultConfig
+from toutiao.resources.news import article as article_resource
+from utils.circuit_breaker import CircuitBreaker
+
+
+def _recommend(article_id):
+    track = SimpleNamespace(click='click', collect='collect', share='share', read='read')
+    return SimpleNamespace(article_id=article_id, track=track)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['RPC'] = DefaultConfig.RPC
+    app.redis_cluster = mock.MagicMock()
+    app.rpc_reco_breaker = CircuitBreaker()
+
+    response = SimpleNamespace(recommends=[_recommend(1), _recommend(2)], time_stamp=123)
+    future = mock.MagicMock()
+    future.result.return_value = response
+    app.rpc_reco_pool = mock.MagicMock()
+    app.rpc_reco_pool.future.return_value = future
+    return app
+
+
+def test_feed_with_cold_attitude_cache(app):
+    """
+    用户文章态度缓存不存在时，组装文章列表需要重建缓存
+    """
+    rc = app.redis_cluster
+    rc.exists.return_value = 0
+    rc.hgetall.return_value = {}
+    # 第一次为重建缓存的hmset/expire，第二次为获取当前页态度的exists/hmget
+    rc.pipeline.return_value.execute.side_effect = [[True, True], [1, [None, b'0']]]
+
+    attitudes = [SimpleNamespace(article_id=2, attitude=0)]
+    articles = [{'id': 1}, {'id': 2}]
+
+    with mock.patch.object(cache_user, 'Attitude') as attitude_model, \
+            mock.patch.object(cache_user, 'load_only'), \
+            mock.patch.object(article_resource.cache_article.ArticleInfoCache, 'get_many', return_value=articles):
+        attitude_model.query.options.return_value.filter.return_value.all.return_value = attitudes
+
+        with app.app_context():
+            page, fallback = article_resource.ArticleListResource()._build_page(1, 1, 123456, 0, 10)
+
+    assert not fallback
+    assert page['pre_timestamp'] == 123
+    # 不喜欢的文章被过滤
+    assert [article['id'] for article in page['results']] == [1]
+
+    ttl = rc.pipeline.return_value.expire.call_args[0][1]
+    assert isinstance(ttl, int) and ttl > 0
@@ -0,0 +1,37 @@
+from unittest import mock
+
+from utils import circuit_breaker
+from utils.circuit_breaker import CircuitBreaker
+
+
+def _open_breaker(now):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    with mock.patch.object(circuit_breaker.time, 'monotonic', return_value=now):
+        breaker.record_failure()
+    return breaker
+
+
+def test_lost_trial_expires():
+    """
+    试探请求未记录结果时，超过恢复时间后放行新的试探请求
+    """
+    breaker = _open_breaker(0)
+
+    with mock.patch.object(circuit_breaker.time, 'monotonic') as monotonic:
+        monotonic.return_value = 30
+        assert breaker.allow()
+        monotonic.return_value = 40
+        assert not breaker.allow()
+        monotonic.return_value = 60
+        assert breaker.allow()
+
+
+def test_trial_success_closes():
+    breaker = _open_breaker(0)
+
+    with mock.patch.object(circuit_breaker.time, 'monotonic', return_value=30):
+        assert breaker.allow()
+        breaker.record_success()
+
+    assert not breaker.is_open
+    assert breaker.allow()
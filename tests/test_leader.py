@@ -0,0 +1,102 @@
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+from cache.singleflight import RELEASE_LOCK_SCRIPT
+from toutiao.schedule import leader
+
+INTERVAL = 60
+
+
+class Clock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeRedis(object):
+    """
+    只实现领导锁用到的命令，过期时间使用模拟时钟
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+
+    def _get(self, key):
+        value, expire_at = self.data.get(key, (None, None))
+        if expire_at is not None and self.clock.now >= expire_at:
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and self._get(key) is not None:
+            return None
+        self.data[key] = (value, self.clock.now + px / 1000 if px else None)
+        return True
+
+    def eval(self, script, numkeys, key, token, *args):
+        if self._get(key) != token:
+            return 0
+        if script == RELEASE_LOCK_SCRIPT:
+            del self.data[key]
+        else:
+            self.data[key] = (token, self.clock.now + args[0] / 1000)
+        return 1
+
+    def hmset(self, key, mapping):
+        return True
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch.object(leader.time, 'time', clock.time):
+        yield clock
+
+
+@pytest.fixture
+def app(clock):
+    app = Flask(__name__)
+    app.redis_master = FakeRedis(clock)
+    return app
+
+
+def _job(clock, runs):
+    def job():
+        runs.append(clock.now)
+        clock.now += 2
+        return 1
+    return job
+
+
+def test_consecutive_triggers_both_run(app, clock):
+    """
+    同一进程相邻两次触发都能执行，第二次触发早于第一次获取锁后的一个完整间隔
+    """
+    runs = []
+
+    # 第一次触发后经过派发延迟才获取到锁
+    clock.now = 0.2
+    assert leader.run_as_leader(app, 'job', INTERVAL, _job(clock, runs)) == 1
+
+    clock.now = INTERVAL + 0.01
+    assert leader.run_as_leader(app, 'job', INTERVAL, _job(clock, runs)) == 1
+
+    assert len(runs) == 2
+
+
+def test_other_worker_skips_within_interval(app, clock):
+    runs = []
+
+    assert leader.run_as_leader(app, 'job', INTERVAL, _job(clock, runs)) == 1
+
+    # 其他进程在本间隔内触发时跳过
+    clock.now = INTERVAL / 2
+    assert leader.run_as_leader(app, 'job', INTERVAL, _job(clock, runs)) is None
+
+    assert len(runs) == 1
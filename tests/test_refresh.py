@@ -0,0 +1,46 @@
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+from cache import refresh
+
+
+class ImmediatePool(object):
+    def submit(self, app, key, func):
+        with app.app_context():
+            func()
+        return True
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.redis_cluster = mock.MagicMock()
+    app.local_cache = mock.MagicMock()
+    app.cache_refresh_pool = ImmediatePool()
+    return app
+
+
+def test_skip_refresh_when_refreshed_by_other_worker(app):
+    """
+    其他进程已刷新redis中的缓存时只删除本进程的一级缓存，不再查询数据库
+    """
+    app.redis_cluster.get.return_value = b'new'
+    save = mock.MagicMock()
+
+    with app.app_context(), mock.patch.object(refresh.singleflight, 'rebuild') as rebuild:
+        refresh.refresh_in_background('art:1:info', save, None, b'old')
+
+    rebuild.assert_not_called()
+    app.local_cache.delete.assert_called_once_with('art:1:info')
+
+
+def test_refresh_when_still_stale(app):
+    app.redis_cluster.get.return_value = b'old'
+    save = mock.MagicMock()
+
+    with app.app_context(), mock.patch.object(refresh.singleflight, 'rebuild') as rebuild:
+        refresh.refresh_in_background('art:1:info', save, None, b'old')
+
+    rebuild.assert_called_once_with('art:1:info', save, None)
@@ -59,9 +59,35 @@ def create_app(config, enable_config_file=False):
     from rediscluster import StrictRedisCluster
     app.redis_cluster = StrictRedisCluster(startup_nodes=app.config['REDIS_CLUSTER'])
 
+    # 进程内一级缓存，通过redis pub/sub接收失效通知
+    from cache.local import LocalCache, LocalCacheInvalidationListener
+    app.local_cache = LocalCache()
+    LocalCacheInvalidationListener(app).start()
+
+    # 缓存后台刷新线程池
+    from cache.refresh import RefreshPool
+    app.cache_refresh_pool = RefreshPool()
+
+    # 推荐文章列表预取线程池
+    from cache import constants as cache_constants
+    app.feed_prefetch_pool = RefreshPool(cache_constants.FEED_PREFETCH_POOL_MAX_WORKERS,
+                                         cache_constants.FEED_PREFETCH_POOL_MAX_PENDING)
+
+    # 统计数据增量缓冲，合并热点计数的写入
+    from cache.persstorage import CountIncrBuffer
+    app.count_incr_buffer = CountIncrBuffer(app)
+    app.count_incr_buffer.start()
+
     # rpc
 
-    app.rpc_reco_channel = grpc.insecure_channel(app.config['RPC'].RECOMMEND)
+    # 推荐系统通道池，在多个后端之间负载均衡
+    from utils.rpc_pool import ChannelPool
+    app.rpc_reco_pool = ChannelPool(app.config['RPC'].RECOMMEND, app.config['RPC'].RECOMMEND_BALANCE)
+
+    # 推荐系统熔断器
+    from utils.circuit_breaker import CircuitBreaker
+    app.rpc_reco_breaker = CircuitBreaker(app.config['RPC'].RECOMMEND_BREAKER_FAILURES,
+                                          app.config['RPC'].RECOMMEND_BREAKER_RECOVERY)
 
     # app.rpc_reco = grpc.insecure_channel(app.config['RPC'].RECOMMEND)
 
@@ -94,6 +120,8 @@ def create_app(config, enable_config_file=False):
     # 触发器
     from apscheduler.triggers import date, interval, cron
     from toutiao.schedule.statistics import fix_statistics
+    from toutiao.schedule.bloom_filter import update_bloom_filters
+    from toutiao.schedule.fallback_feed import update_fallback_feeds
 
     # 1.创建执行器对象executors
     executors = {
@@ -114,6 +142,24 @@ def create_app(config, enable_config_file=False):
     # app.scheduler.add_job(func=fix_statistics, trigger="cron", hour=4, args=[app])
     app.scheduler.add_job(func=fix_statistics, trigger="date", args=[app])
 
+    # 每10分钟增量修正上次修正后有变化的统计数据
+    app.scheduler.add_job(func=fix_statistics, trigger="interval",
+                          seconds=cache_constants.SCHEDULE_FIX_STATISTICS_INTERVAL, args=[app])
+
+    # 按需开启每天定时全量修正
+    if app.config.get('STATISTICS_FULL_FIX_HOUR') is not None:
+        app.scheduler.add_job(func=fix_statistics, trigger="cron", hour=app.config['STATISTICS_FULL_FIX_HOUR'],
+                              args=[app], kwargs={'full': True})
+
+    # 每分钟将新增的id加入布隆过滤器
+    app.scheduler.add_job(func=update_bloom_filters, trigger="interval",
+                          seconds=cache_constants.SCHEDULE_BLOOM_FILTER_INTERVAL, args=[app])
+
+    # 启动时及每5分钟更新推荐系统不可用时使用的降级文章列表
+    app.scheduler.add_job(func=update_fallback_feeds, trigger="date", args=[app])
+    app.scheduler.add_job(func=update_fallback_feeds, trigger="interval",
+                          seconds=cache_constants.SCHEDULE_FALLBACK_FEED_INTERVAL, args=[app])
+
     # 4.开启定时任务
     app.scheduler.start()
 
@@ -1,5 +1,6 @@
 import time
 
+import grpc
 from flask import current_app, g
 from flask_restful import Resource, reqparse, inputs
 from flask_restful.reqparse import RequestParser
@@ -7,30 +8,157 @@ from flask_restful.reqparse import RequestParser
 from cache.article import ArticleInfoCache
 from sqlalchemy.exc import DatabaseError
 from cache import article as cache_article
+from cache import user as cache_user
+from models.news import Attitude
 from rpc import reco_pb2, reco_pb2_grpc
 
 
 class ArticleListResource(Resource):
     '''通过自己封装的工具类获取某篇新闻的信息'''
 
-    def _feed_articles(self, channel_id, timestamp, feed_count):
-        # 连接grpc服务器
-        channel = current_app.rpc_reco_channel
-
-        # 获取stub对象
-        stub = reco_pb2_grpc.UserArticleRecommendStub(channel)
-
+    def _feed_articles(self, user_id, channel_id, timestamp, feed_count):
+        """
+        异步请求推荐系统
+        :return: grpc future对象，result()返回推荐系统的响应
+        """
         # 组织请求对象
         request = reco_pb2.UserRequest()
         # 首页不要求用户强制登录  没有登录设置匿名用户: "annoy"
-        request.user_id = str(g.user_id) if g.user_id else "annoy"
+        request.user_id = str(user_id) if user_id else "annoy"
         request.channel_id = channel_id
         request.article_num = feed_count
         request.time_stamp = timestamp
 
-        article_response = stub.user_recommend(request)
+        # 由通道池选择推荐系统后端
+        return current_app.rpc_reco_pool.future(reco_pb2_grpc.UserArticleRecommendStub, 'user_recommend', request,
+                                                timeout=current_app.config['RPC'].RECOMMEND_TIMEOUT)
+
+    def _feed_result(self, feed_future):
+        """
+        获取推荐结果，超时或出错时记录到熔断器
+        :return: [(article_id, trace), ...], pre_timestamp，推荐系统不可用时返回None, None
+        """
+        breaker = current_app.rpc_reco_breaker
+        try:
+            article_response = feed_future.result()
+        except grpc.RpcError as e:
+            current_app.logger.error('recommend rpc failed: {}'.format(e))
+            breaker.record_failure()
+            return None, None
+
+        breaker.record_success()
+
+        feeds = []
+        for feed in article_response.recommends:
+            # 埋点参数
+            feeds.append((feed.article_id, {
+                'click': feed.track.click,
+                'collect': feed.track.collect,
+                'share': feed.track.share,
+                'read': feed.track.read
+            }))
+        return feeds, article_response.time_stamp
+
+    def _fallback_feed_articles(self, channel_id, timestamp, feed_count):
+        """
+        推荐系统不可用时从降级文章列表获取，埋点参数标记为降级
+        :return: [(article_id, trace), ...], pre_timestamp
+        """
+        ret = cache_article.ChannelFallbackArticlesStorage(channel_id).get(timestamp, feed_count)
+
+        feeds = []
+        for article_id, article_timestamp in ret:
+            feeds.append((article_id, {
+                'click': 'fallback click {}'.format(article_id),
+                'collect': 'fallback collect {}'.format(article_id),
+                'share': 'fallback share {}'.format(article_id),
+                'read': 'fallback read {}'.format(article_id)
+            }))
+
+        pre_timestamp = ret[-1][1] if ret else timestamp
+        return feeds, pre_timestamp
+
+    def _build_page(self, user_id, channel_id, timestamp, with_top, per_page):
+        """
+        请求推荐系统并组装文章列表
+        :return: 文章列表响应数据, 是否为降级结果
+        """
+        feed_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time()))
+
+        results = []
+
+        # 调用grpc 获取推荐文章列表，请求进行中同时加载与推荐结果无关的数据
+        # 熔断期间不再请求推荐系统
+        feed_future = None
+        if current_app.rpc_reco_breaker.allow():
+            feed_future = self._feed_articles(user_id, channel_id, timestamp, per_page)
+
+        # 置顶文章
+        if with_top:
+            top_article_ids = cache_article.ChannelTopArticlesStorage(channel_id).get()
+            for article in cache_article.ArticleInfoCache.get_many(top_article_ids):
+                if article:
+                    article['pubdate'] = feed_time
+                    results.append(article)
+
+        # 用户文章态度，缓存不存在时提前重建，推荐结果返回后只需一次HMGET
+        attitude_cache = None
+        if user_id:
+            attitude_cache = cache_user.UserArticleAttitudeCache(user_id)
+            attitude_cache.ensure()
+
+        feeds, pre_timestamp = None, None
+        if feed_future is not None:
+            feeds, pre_timestamp = self._feed_result(feed_future)
+
+        # 推荐系统超时、出错或熔断时使用降级文章列表
+        fallback = feeds is None
+        if fallback:
+            feeds, pre_timestamp = self._fallback_feed_articles(channel_id, timestamp, per_page)
+
+        # 从缓存工具类中批量获取文章数据，结果与feeds顺序一致
+        article_ids = [article_id for article_id, trace in feeds]
+        articles = cache_article.ArticleInfoCache.get_many(article_ids)
+        attitudes = attitude_cache.prefetch(article_ids) if attitude_cache else {}
+        top_article_ids = {article['id'] for article in results}
+
+        # 查询文章
+        for (article_id, trace), article in zip(feeds, articles):
+            # 过滤已置顶和用户不喜欢的文章
+            if article_id in top_article_ids or attitudes.get(article_id) == Attitude.ATTITUDE.DISLIKE:
+                continue
+
+            # 文章对象
+            if article:
+                article['pubdate'] = feed_time
+                # 埋点参数
+                article['trace'] = trace
+                results.append(article)
+
+        if fallback:
+            return {'pre_timestamp': pre_timestamp, 'results': results, 'fallback': True}, True
+
+        return {'pre_timestamp': pre_timestamp, 'results': results}, False
+
+    def _prefetch(self, user_id, channel_id, timestamp, with_top, per_page):
+        """
+        在后台获取下一页并放入分页结果缓存，下次翻页只需读取一次redis
+        线程池有上限，繁忙时放弃预取
+        """
+        if not current_app.config.get('FEED_PREFETCH'):
+            return
+
+        page_cache = cache_article.FeedPageCache(user_id, channel_id, timestamp, with_top)
 
-        return article_response.recommends, article_response.time_stamp
+        def prefetch():
+            if page_cache.exists():
+                return
+            page, fallback = self._build_page(user_id, channel_id, timestamp, with_top, per_page)
+            if not fallback:
+                page_cache.save(page)
+
+        app = current_app._get_current_object()
+        app.feed_prefetch_pool.submit(app, page_cache.key, prefetch)
 
     def get(self):
         """
@@ -43,6 +171,8 @@ class ArticleListResource(Resource):
         qs_parser.add_argument('channel_id', type=int, required=True, location='args')
         # 时间戳
         qs_parser.add_argument('timestamp', type=inputs.positive, required=True, location='args')
+        # 是否包含置顶文章
+        qs_parser.add_argument('with_top', type=inputs.int_range(0, 1), required=False, default=0, location='args')
         # 开启参数解析
         args = qs_parser.parse_args()
 
@@ -51,35 +181,15 @@ class ArticleListResource(Resource):
         # 推荐文章数量
         per_page = 10
 
-        try:
-            feed_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time()))
-        except Exception:
-            return {'message': 'timestamp param error'}, 400
+        # 重复请求、回翻或已预取时使用已组装好的结果，只有新的请求才调用推荐系统
+        page_cache = cache_article.FeedPageCache(g.user_id, channel_id, timestamp, args.with_top)
+        page = page_cache.get()
+        if page is None:
+            page, fallback = self._build_page(g.user_id, channel_id, timestamp, args.with_top, per_page)
+            if fallback:
+                return page
+            page_cache.save(page)
 
-        results = []
-
-        # TODO: 调用grpc 获取推荐文章列表
-        feeds, pre_timestamp = self._feed_articles(channel_id, timestamp, per_page)
-
-        # 查询文章
-        for feed in feeds:
-            # feed 代表的 Article 文章
-            # feed.article_id 文章id
-
-            # 从缓存工具类中获取文章数据
-
-            article = cache_article.ArticleInfoCache(feed.article_id).get()
-
-            # 文章对象
-            if article:
-                article['pubdate'] = feed_time
-                # 埋点参数
-                article['trace'] = {
-                    'click': feed.track.click,
-                    'collect': feed.track.collect,
-                    'share': feed.track.share,
-                    'read': feed.track.read
-                }
-                results.append(article)
+        self._prefetch(g.user_id, channel_id, page['pre_timestamp'], args.with_top, per_page)
 
-        return {'pre_timestamp': pre_timestamp, 'results': results}
+        return page
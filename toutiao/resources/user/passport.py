@@ -13,6 +13,7 @@ from models import db
 from models.user import User, UserProfile
 from utils.jwt_util import generate_jwt
 # from cache import user as cache_user
+from cache.bloom import UserBloomFilter
 from utils.limiter import limiter as lmt
 from utils.decorators import set_db_to_read, set_db_to_write, login_required
 
@@ -122,6 +123,8 @@ class AuthorizationResource(Resource):
             profile = UserProfile(id=user.id)
             db.session.add(profile)
             db.session.commit()
+            # 新用户加入布隆过滤器，避免被判断为不存在
+            UserBloomFilter.add(user.id)
         else:
             if user.status == User.STATUS.DISABLE:
                 return {'message': 'Invalid user.'}, 403
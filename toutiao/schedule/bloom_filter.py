@@ -0,0 +1,14 @@
+from cache import constants
+from cache.bloom import ArticleBloomFilter, UserBloomFilter, CommentBloomFilter
+from .leader import run_as_leader
+
+
+def update_bloom_filters(app):
+    # 将新增的文章、用户、评论id加入布隆过滤器，位图不存在时全量建立
+    with app.app_context():
+        for cls_name in (ArticleBloomFilter, UserBloomFilter, CommentBloomFilter):
+            try:
+                run_as_leader(app, 'update_bloom_filter:{}'.format(cls_name.key),
+                              constants.SCHEDULE_BLOOM_FILTER_INTERVAL, cls_name.update)
+            except Exception as e:
+                app.logger.error(e)
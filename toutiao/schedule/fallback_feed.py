@@ -0,0 +1,53 @@
+import heapq
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from cache import constants
+from cache.article import ChannelFallbackArticlesStorage
+from cache.persstorage import BaseCountStorage, ArticleReadingCountStorage, ArticleCommentCountStorage, \
+    ArticleDislikeCountStorage
+from models.news import Article
+from .leader import run_as_leader
+
+# 推荐频道id，降级时展示所有频道的热门文章
+RECOMMEND_CHANNEL_ID = 0
+
+
+def update_fallback_feeds(app):
+    # 从近期审核通过的文章中按热度为每个频道选出降级文章列表
+    with app.app_context():
+        run_as_leader(app, 'update_fallback_feeds', constants.SCHEDULE_FALLBACK_FEED_INTERVAL, __update_fallback_feeds)
+
+
+def __hot_score(reading_count, comment_count, dislike_count, ctime, now):
+    # 互动越多越热，随发布时间衰减
+    hours = max(now - ctime.timestamp(), 0) / 3600
+    return (reading_count + 5 * comment_count - 10 * dislike_count + 1) / (hours + 2) ** 1.5
+
+
+def __update_fallback_feeds():
+    since = datetime.now() - timedelta(days=constants.FALLBACK_FEED_DAYS)
+    ret = Article.query.with_entities(Article.id, Article.channel_id, Article.ctime) \
+        .filter(Article.status == Article.STATUS.APPROVED, Article.ctime >= since) \
+        .order_by(Article.ctime.desc()).limit(constants.FALLBACK_FEED_CANDIDATES).all()
+
+    now = time.time()
+    channels = defaultdict(list)
+    for i in range(0, len(ret), constants.COUNT_STORAGE_RESET_CHUNK_SIZE):
+        chunk = ret[i:i + constants.COUNT_STORAGE_RESET_CHUNK_SIZE]
+        counts = BaseCountStorage.get_multi_storage(
+            [article_id for article_id, channel_id, ctime in chunk],
+            [ArticleReadingCountStorage, ArticleCommentCountStorage, ArticleDislikeCountStorage])
+
+        for (article_id, channel_id, ctime), (reading_count, comment_count, dislike_count) in zip(chunk, counts):
+            item = (__hot_score(reading_count, comment_count, dislike_count, ctime, now),
+                    article_id, int(ctime.timestamp() * 1000))
+            channels[channel_id].append(item)
+            channels[RECOMMEND_CHANNEL_ID].append(item)
+
+    for channel_id, items in channels.items():
+        top = heapq.nlargest(constants.FALLBACK_FEED_SIZE, items)
+        ChannelFallbackArticlesStorage(channel_id).save([(article_id, timestamp) for _, article_id, timestamp in top])
+
+    return len(ret)
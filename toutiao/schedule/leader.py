@@ -0,0 +1,115 @@
+import threading
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+from cache import constants
+from cache.singleflight import RELEASE_LOCK_SCRIPT
+
+
+# 仅当锁仍属于自己时才续期
+RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
+
+class LeaderLock(object):
+    """
+    定时任务领导锁，每个gunicorn进程都启动了调度器，通过redis锁保证整个部署中同一任务同时只有一个进程执行
+    持有期间后台线程定期续期，进程异常退出后锁在租期结束时自动释放
+    各进程调度器的触发时间互相错开，任务完成后锁保留到本次开始后的一个执行间隔减去一小段余量，保证每个间隔只执行一次
+    """
+
+    def __init__(self, app, name, ttl=constants.SCHEDULE_LOCK_TTL):
+        self.app = app
+        self.key = 'lock:schedule:{}'.format(name)
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        """
+        获取锁
+        :return: 是否获取成功
+        """
+        if not self.app.redis_master.set(self.key, self.token, nx=True, px=self.ttl):
+            return False
+
+        self._thread = threading.Thread(target=self._renew, name='schedule-lock-renew', daemon=True)
+        self._thread.start()
+        return True
+
+    def _renew(self):
+        while not self._stopped.wait(self.ttl / 3000):
+            try:
+                renewed = self.app.redis_master.eval(RENEW_LOCK_SCRIPT, 1, self.key, self.token, self.ttl)
+            except RedisError as e:
+                self.app.logger.error(e)
+                continue
+
+            if not renewed:
+                self.app.logger.error('schedule lock {} lost'.format(self.key))
+                return
+
+    def release(self, hold=0):
+        """
+        停止续期并释放锁
+        :param hold: 锁继续保留的时长，秒，大于0时只设置过期时间而不删除
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        try:
+            if hold > 0:
+                self.app.redis_master.eval(RENEW_LOCK_SCRIPT, 1, self.key, self.token, int(hold * 1000))
+            else:
+                self.app.redis_master.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+        except RedisError as e:
+            self.app.logger.error(e)
+
+
+def run_as_leader(app, name, interval, func, *args, **kwargs):
+    """
+    获取领导锁后执行任务并记录执行耗时与处理的数据条数，其他进程正在执行或本间隔内已执行时直接跳过
+    :param name: 任务名称
+    :param interval: 任务执行间隔，秒
+    :param func: 任务函数，返回处理的数据条数
+    :return: func的返回值，未执行时返回None
+    """
+    lock = LeaderLock(app, name)
+    try:
+        if not lock.acquire():
+            return None
+    except RedisError as e:
+        app.logger.error(e)
+        return None
+
+    start = time.time()
+    try:
+        rows = func(*args, **kwargs)
+    except Exception:
+        # 执行失败时立即释放，其他进程下次触发时重试
+        lock.release()
+        raise
+    duration = time.time() - start
+    # 锁在下次触发前结束，开始时间晚于触发时间，保留整个间隔会使下次触发被跳过
+    lock.release(hold=interval - constants.SCHEDULE_LOCK_HOLD_MARGIN - duration)
+
+    app.logger.info('schedule job {} finished in {:.3f}s, {} rows'.format(name, duration, rows))
+    try:
+        app.redis_master.hmset(constants.SCHEDULE_METRICS_KEY.format(name), {
+            'duration': duration,
+            'rows': rows or 0,
+            'finished_at': time.time()
+        })
+    except RedisError as e:
+        app.logger.error(e)
+
+    return rows
@@ -1,23 +1,92 @@
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from cache import constants
 from cache.persstorage import *
+from .leader import run_as_leader
+
+
+# 需要修正的统计数据
+STORAGES = [
+    UserArticleCountStorage,
+    UserArticleLikingCountStorage,
+    UserFollowingsCountStorage,
+    UserArticleCollectingCountStorage,
+    ArticleDislikeCountStorage,
+    CommentLikingCountStorage,
+    # ArticleReadingCountStorage,
+    # UserArticlesReadingCountStorage,
+    ArticleCommentCountStorage,
+    CommentReplyCountStorage,
+    UserLikedCountStorage,
+    UserFollowersCountStorage,
+]
+
 
+def fix_statistics(app, full=False):
+    """
+    修正统计数据
+    每种统计数据作为一个动态任务交给调度器的线程池并行执行
+    :param full: 是否全量修正，默认只修正上次修正后数据有变化的id
+    """
+    for cls_name in STORAGES:
+        app.scheduler.add_job(func=fix_storage_statistics, trigger="date", args=[app, cls_name, full])
 
-def fix_statistics(app):
-    # 修正用户发布发文章数量
+
+def fix_storage_statistics(app, cls_name, full=False):
+    """
+    修正一种统计数据，整个部署中同时只有一个进程执行
+    """
     with app.app_context():
-        __fix_statistics(UserArticleCountStorage)
-        __fix_statistics(UserArticleLikingCountStorage)
-        __fix_statistics(UserFollowingsCountStorage)
-        __fix_statistics(UserArticleCollectingCountStorage)
-        __fix_statistics(ArticleDislikeCountStorage)
-        __fix_statistics(CommentLikingCountStorage)
-        # __fix_statistics(ArticleReadingCountStorage)
-        # __fix_statistics(UserArticlesReadingCountStorage)
-        __fix_statistics(ArticleCommentCountStorage)
-        __fix_statistics(CommentReplyCountStorage)
-        __fix_statistics(UserLikedCountStorage)
-        __fix_statistics(UserFollowersCountStorage)
-
-
-def __fix_statistics(cls_name):
-    result = cls_name.db_query()
-    cls_name.reset(result)
+        if full:
+            run_as_leader(app, 'fix_statistics:full:{}'.format(cls_name.key),
+                          constants.SCHEDULE_FULL_FIX_STATISTICS_INTERVAL, __fix_statistics, cls_name, full)
+        else:
+            run_as_leader(app, 'fix_statistics:{}'.format(cls_name.key),
+                          constants.SCHEDULE_FIX_STATISTICS_INTERVAL, __fix_statistics, cls_name, full)
+
+
+def __fix_statistics(cls_name, full):
+    redis_master = current_app.redis_master
+
+    # 部署分片配置后先把旧有序集合迁移到分片，再以数据库结果修正
+    cls_name.migrate()
+
+    # 以本次开始时间作为下次增量修正的起点，修正期间发生的变化留给下次处理
+    start = time.time()
+    watermark = redis_master.hget(constants.COUNT_STORAGE_WATERMARK_KEY, cls_name.key)
+
+    if full or watermark is None:
+        rows = __reset_statistics(cls_name)
+    elif cls_name.id_column is None:
+        # 不支持增量修正的统计数据定期全量修正
+        if start - float(watermark) < constants.COUNT_STORAGE_FULL_FIX_INTERVAL:
+            return 0
+        rows = __reset_statistics(cls_name)
+    else:
+        since = datetime.fromtimestamp(float(watermark) - constants.COUNT_STORAGE_WATERMARK_OVERLAP)
+        rows = __patch_statistics(cls_name, since)
+
+    redis_master.hset(constants.COUNT_STORAGE_WATERMARK_KEY, cls_name.key, start)
+    return rows
+
+
+def __reset_statistics(cls_name):
+    # 使用服务端游标分批读取，内存占用与总数据量无关
+    result = cls_name.db_query().execution_options(stream_results=True) \
+        .yield_per(constants.COUNT_STORAGE_RESET_CHUNK_SIZE)
+    return cls_name.reset(result)
+
+
+def __patch_statistics(cls_name, since):
+    # 只重新统计数据有变化的id，统计结果中没有的id数量为0
+    ids = [item_id for item_id, in cls_name.db_query_changed(since) if item_id is not None]
+
+    rows = 0
+    for i in range(0, len(ids), constants.COUNT_STORAGE_RESET_CHUNK_SIZE):
+        chunk = ids[i:i + constants.COUNT_STORAGE_RESET_CHUNK_SIZE]
+        counts = dict(cls_name.db_query().filter(cls_name.id_column.in_(chunk)))
+        rows += cls_name.patch({item_id: counts.get(item_id, 0) for item_id in chunk})
+    return rows